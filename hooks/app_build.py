@@ -1,17 +1,36 @@
+import gzip
 import os
 import shutil
 import subprocess
 from pathlib import Path
 from typing import Any
 
+import brotli
 from hatchling.builders.hooks.plugin.interface import BuildHookInterface
 
+# files the app server can send precompressed, see trifold.app.static
+COMPRESSIBLE_SUFFIXES = {
+    ".css",
+    ".html",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".svg",
+    ".txt",
+    ".wasm",
+    ".webmanifest",
+    ".xml",
+}
+MIN_COMPRESS_SIZE = 1024
+
 
 class BuildHook(BuildHookInterface):
     """Custom build hook for Databricks Apps.
 
     This hook is used to:
     1. build the UI assets for the Databricks Apps project
+       and write gzip and brotli variants of them next to the originals
     2. Prepare the wheel for Databricks Apps by copying it to a ./.build folder
     3. Write a requirements.txt file in the ./.build folder with the name of the wheel
 
@@ -20,6 +39,7 @@ class BuildHook(BuildHookInterface):
 
     def initialize(self, version: str, build_data: dict[str, Any]):
         ui_path = Path("src/trifold/ui")
+        dist_path = Path("src/trifold/app/static/dist")
 
         self.app.display_info(
             f"✨ Running custom build hook for project {self.metadata.name}"
@@ -69,6 +89,37 @@ class BuildHook(BuildHookInterface):
             # Re-raise the exception
             raise
 
+        self.compress_assets(dist_path)
+
+    def compress_assets(self, dist_path: Path) -> None:
+        """Writes .gz and .br variants of text assets, where they are smaller."""
+        self.app.display_info(f"🗜️ Compressing UI assets in {dist_path.absolute()}...")
+        original_size = compressed_size = 0
+        for path in sorted(dist_path.rglob("*")):
+            if not path.is_file() or path.suffix not in COMPRESSIBLE_SUFFIXES:
+                continue
+            data = path.read_bytes()
+            if len(data) < MIN_COMPRESS_SIZE:
+                continue
+
+            variants = {
+                ".gz": gzip.compress(data, compresslevel=9, mtime=0),
+                ".br": brotli.compress(data, quality=11),
+            }
+            for suffix, compressed in variants.items():
+                target = path.with_name(path.name + suffix)
+                if len(compressed) < len(data):
+                    target.write_bytes(compressed)
+                elif target.exists():
+                    target.unlink()
+            original_size += len(data)
+            compressed_size += len(variants[".br"])
+
+        self.app.display_info(
+            f"✅ Compressed {original_size / 1024:.0f} KiB of assets "
+            f"to {compressed_size / 1024:.0f} KiB with brotli"
+        )
+
     def finalize(
         self, version: str, build_data: dict[str, Any], artifact_path: str
     ) -> None:
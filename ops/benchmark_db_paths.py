@@ -0,0 +1,100 @@
+"""
+Benchmark comparing the synchronous and asynchronous database paths of the API.
+
+Each simulated request runs the same query that backs GET /api/desserts,
+either through the blocking `rt.session()` (how the handlers worked before)
+or through the asyncpg-backed `rt.async_session()`. All requests of a round are
+scheduled concurrently on one event loop, the same way a uvicorn worker serves them.
+A ticker coroutine runs alongside and records the event loop lag, which is what
+other requests on the worker (e.g. SSE streams) experience.
+
+Usage:
+    python ops/benchmark_db_paths.py --requests 200 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from sqlmodel import select
+
+from trifold.app.config import rt
+from trifold.app.models import Dessert
+
+
+async def sync_request() -> None:
+    # blocking call inside a coroutine, exactly like the old handlers
+    with rt.session() as session:
+        session.exec(select(Dessert)).all()
+
+
+async def async_request() -> None:
+    async with rt.async_session() as session:
+        result = await session.exec(select(Dessert))
+        result.all()
+
+
+async def measure_loop_lag(stop: asyncio.Event, lags: list[float]) -> None:
+    interval = 0.01
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(request, total: int, concurrency: int) -> dict[str, float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - start)
+
+    # warm up the pool so that connection setup is not measured
+    await request()
+
+    lags: list[float] = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_loop_lag(stop, lags))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await ticker
+
+    return {
+        "throughput_rps": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": statistics.quantiles(latencies, n=20)[-1] * 1000,
+        "max_loop_lag_ms": max(lags, default=0.0) * 1000,
+    }
+
+
+async def main(total: int, concurrency: int) -> None:
+    results = {
+        "sync (before)": await run(sync_request, total, concurrency),
+        "async (after)": await run(async_request, total, concurrency),
+    }
+
+    print(f"{total} requests, concurrency {concurrency}")
+    print(f"{'path':<16}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'loop lag ms':>14}")
+    for name, r in results.items():
+        print(
+            f"{name:<16}{r['throughput_rps']:>10.1f}{r['p50_ms']:>10.1f}"
+            f"{r['p95_ms']:>10.1f}{r['max_loop_lag_ms']:>14.1f}"
+        )
+
+    await rt.async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
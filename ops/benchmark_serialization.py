@@ -0,0 +1,110 @@
+"""
+Benchmark of the read path of GET /api/desserts, from fetched rows to JSON bytes.
+
+The desserts are loaded into an in-memory SQLite copy of the table, so that the
+numbers show the cost of row processing and serialization, not the network.
+Compared paths:
+- orm (before): ORM instances, `DessertOut.from_model` per row, then the response
+  model handling of FastAPI (dump to dicts, re-validation, json.dumps)
+- core (after): plain Core rows serialized by a precompiled TypeAdapter
+- cache (after): rows from the in-memory cache, already DessertOut models
+
+Usage:
+    python ops/benchmark_serialization.py --rows 10000 1000000
+"""
+
+import argparse
+import json
+import time
+from typing import Callable
+
+from sqlalchemy import Engine, create_engine, insert
+from sqlmodel import Session, select
+
+from trifold.app.models import DESSERT_LIST, DESSERT_ROWS, Dessert, DessertOut
+from trifold.app.queries import dessert_table
+
+
+def load(rows: int) -> Engine:
+    engine = create_engine("sqlite://")
+    table = dessert_table()
+    table.create(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(table),
+            [
+                {
+                    "id": i,
+                    "name": f"Dessert {i}",
+                    "price": round(1 + (i % 1000) / 100, 2),
+                    "description": "Benchmark dessert with a short description",
+                    "left_in_stock": i % 50,
+                    "version": 1,
+                }
+                for i in range(1, rows + 1)
+            ],
+        )
+    return engine
+
+
+def orm_path(engine: Engine) -> bytes:
+    with Session(engine) as session:
+        outs = [DessertOut.from_model(d) for d in session.exec(select(Dessert)).all()]
+    # what FastAPI does with a returned list and response_model=list[DessertOut]
+    content = [out.model_dump(by_alias=True) for out in outs]
+    value = DESSERT_LIST.validate_python(content)
+    return json.dumps(
+        DESSERT_LIST.dump_python(value, mode="json"),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode()
+
+
+def core_path(engine: Engine) -> bytes:
+    with engine.connect() as conn:
+        rows = conn.execute(select(*dessert_table().c)).all()
+    return DESSERT_ROWS.dump_json([row._asdict() for row in rows], by_alias=True)
+
+
+def measure(path: Callable[[], bytes], rows: int, repeat: int) -> tuple[float, bytes]:
+    best = float("inf")
+    body = b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = path()
+        best = min(best, time.perf_counter() - start)
+    return rows / best, body
+
+
+def main(sizes: list[int], repeat: int) -> None:
+    print(f"{'rows':>10}  {'path':<14}{'rows/s':>14}{'MB':>8}")
+    for rows in sizes:
+        engine = load(rows)
+        with Session(engine) as session:
+            cached = [DessertOut.from_model(d) for d in session.exec(select(Dessert))]
+
+        paths: dict[str, Callable[[], bytes]] = {
+            "orm (before)": lambda engine=engine: orm_path(engine),
+            "core (after)": lambda engine=engine: core_path(engine),
+            "cache (after)": lambda cached=cached: DESSERT_LIST.dump_json(cached),
+        }
+        bodies = {}
+        for name, path in paths.items():
+            rate, bodies[name] = measure(path, rows, repeat)
+            size = len(bodies[name]) / 1e6
+            print(f"{rows:>10}  {name:<14}{rate:>14,.0f}{size:>8.1f}")
+
+        # all paths must produce the same response
+        expected = json.loads(bodies["orm (before)"])
+        assert all(json.loads(body) == expected for body in bodies.values())
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
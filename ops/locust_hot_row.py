@@ -0,0 +1,96 @@
+"""
+Hot row scenario for the Trifold stock reservation endpoints, using Locust.
+
+All users reserve stock of the same dessert, so every reservation contends
+for one row lock:
+- POST /api/desserts/{id}/reserve (reserve a single dessert)
+- POST /api/desserts:reserve (reserve several desserts, all or nothing)
+
+Kept apart from locust_test.py, so the regular load profiles are unaffected.
+
+Usage:
+    locust -f ops/locust_hot_row.py --host=http://localhost:8080 -u 50 -r 5
+"""
+
+import random
+from locust import HttpUser, task, between
+from gevent.lock import Semaphore
+from locust.clients import ResponseContextManager
+from locust_test import TEST_DESSERT_PREFIX, auth_headers
+
+
+class HotDessertUser(HttpUser):
+    """
+    A Locust user that hammers a single hot dessert with stock reservations.
+
+    All users share one dessert, so every reservation contends for the same row lock.
+    Running out of stock (409) is an expected outcome and counted as success,
+    the stock is then topped up again with a PATCH.
+    """
+
+    wait_time = between(0.0, 0.05)
+
+    hot_stock = 1_000_000
+    hot_dessert_id: int | None = None
+    _setup_lock = Semaphore()
+
+    def on_start(self):
+        """Create the hot dessert once, shared by all users."""
+        with HotDessertUser._setup_lock:
+            if HotDessertUser.hot_dessert_id is None:
+                response = self.client.post(
+                    "/api/desserts",
+                    json={
+                        "name": f"{TEST_DESSERT_PREFIX} Hot Dessert",
+                        "price": 4.99,
+                        "description": "Shared by all users of the hot row scenario",
+                        "leftInStock": self.hot_stock,
+                    },
+                    headers={**auth_headers, "Content-Type": "application/json"},
+                )
+                HotDessertUser.hot_dessert_id = response.json()["id"]
+
+    def _check_reservation(self, response: ResponseContextManager):
+        if response.status_code in (200, 409):
+            response.success()
+        else:
+            response.failure(f"HTTP {response.status_code}")
+        if response.status_code == 409:
+            self._restock()
+
+    def _restock(self):
+        self.client.patch(
+            f"/api/desserts/{self.hot_dessert_id}",
+            json={"leftInStock": self.hot_stock},
+            headers={**auth_headers, "Content-Type": "application/json"},
+            name="/api/desserts/{id}",
+        )
+
+    @task(5)
+    def reserve_hot_dessert(self):
+        """Test POST /api/desserts/{id}/reserve on the hot dessert."""
+        with self.client.post(
+            f"/api/desserts/{self.hot_dessert_id}/reserve",
+            json={"quantity": random.randint(1, 3)},
+            headers={**auth_headers, "Content-Type": "application/json"},
+            catch_response=True,
+            name="/api/desserts/{id}/reserve",
+        ) as response:
+            assert isinstance(response, ResponseContextManager)
+            self._check_reservation(response)
+
+    @task(1)
+    def reserve_batch(self):
+        """Test POST /api/desserts:reserve with the hot dessert in every batch."""
+        with self.client.post(
+            "/api/desserts:reserve",
+            json={
+                "items": [
+                    {"id": self.hot_dessert_id, "quantity": random.randint(1, 3)},
+                ]
+            },
+            headers={**auth_headers, "Content-Type": "application/json"},
+            catch_response=True,
+        ) as response:
+            assert isinstance(response, ResponseContextManager)
+            self._check_reservation(response)
@@ -1,23 +1,265 @@
 import asyncio
 from functools import partial
-from typing import AsyncGenerator
-import asyncpg
+import json
+from typing import Annotated, Any, AsyncGenerator
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
-from sqlmodel import select
-from fastapi import FastAPI, HTTPException, Request, Response, status
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from pydantic import ValidationError
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from trifold import __version__
-from trifold.app.config import rt
-from trifold.app.dependencies import get_user_workspace_client
+from trifold.app.cache import cache
+from trifold.app.changelog import replay_changes
+from trifold.app.config import conf, rt
+from trifold.app.export import MEDIA_TYPES, export_page, stream_desserts
+from trifold.app.importer import ImportRowError, import_desserts
+from trifold.app.metrics import MetricsMiddleware, render
+from trifold.app.dependencies import get_user_profile
 from trifold.app.models import (
     Dessert,
     DessertIn,
+    DESSERT_LIST,
+    DESSERT_ROWS,
     DessertOut,
+    DessertPatchIn,
+    BatchItemStatus,
+    DessertBatchIn,
+    DessertBatchItemOut,
+    DessertBatchOut,
+    DessertExportQuery,
+    DessertImportOut,
+    DessertQuery,
+    DessertSubscription,
+    DataFormat,
+    ImportMode,
+    PoolStatsView,
     ProfileView,
+    ReservationBatchIn,
+    ReservationBatchOut,
+    ReservationIn,
+    ReservationItemOut,
+    ReservationStatus,
     VersionView,
     get_cached_version,
 )
-from trifold.app.utils import custom_openapi
-from trifold.app.notify import NOTIFY_CHANNEL, Notification, NotificationOut
+from trifold.app.queries import (
+    NEXT_CURSOR_HEADER,
+    DessertCursor,
+    InvalidCursorError,
+    build_select,
+    build_snapshot,
+    dessert_table,
+    delete_many,
+    delete_one,
+    insert_many,
+    paginate,
+    reserve_many,
+    update_many,
+    update_one,
+)
+from trifold.app.utils import custom_openapi, etag_matches
+from trifold.app.hub import RESYNC_FRAME, hub
+from trifold.app.notify import BulkChangeOut, NotificationOut, OperationType
+from trifold.app.ws import (
+    SNAPSHOT_LIMIT,
+    ClientMessage,
+    DeltaSession,
+    EditMessage,
+    SubscribeMessage,
+    encode_row,
+)
+
+HEARTBEAT_FRAME = b": heartbeat\n\n"
+
+# small responses are not worth the CPU, SSE streams are never compressed
+GZIP_MINIMUM_SIZE = 4096
+
+
+def table_etag() -> str | None:
+    version = hub.table_version
+    # prefixed, so it is never taken for a row version by If-Match
+    return f'"t{version}"' if version is not None else None
+
+
+def set_cache_headers(response: Response, etag: str | None) -> None:
+    # clients may keep the body, but have to revalidate it on every use
+    response.headers["Cache-Control"] = "no-cache"
+    if etag is not None:
+        response.headers["ETag"] = etag
+
+
+def not_modified(etag: str | None) -> Response:
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    set_cache_headers(response, etag)
+    return response
+
+
+def if_match_versions(request: Request) -> list[int] | None:
+    """
+    Row versions accepted by the If-Match header of a write, None if any is.
+    Weak or unknown tags never match, so a write with only those fails with 412.
+    """
+    header = request.headers.get("If-Match")
+    if header is None or header.strip() == "*":
+        return None
+    tags = (tag.strip() for tag in header.split(","))
+    return [
+        int(tag[1:-1])
+        for tag in tags
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit()
+    ]
+
+
+async def unwritten(
+    session: AsyncSession, dessert_id: int, versions: list[int] | None
+) -> DessertOut:
+    """
+    Explains a write that matched no row. The dessert is returned if the write was
+    skipped because it would not change anything, otherwise 404 or 412 is raised.
+    Only runs when a write matched nothing, never on the happy path.
+    """
+    model = await session.get(Dessert, dessert_id)
+    if model is None:
+        raise HTTPException(status_code=404, detail="Dessert not found")
+    if versions is not None and model.version not in versions:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Dessert was changed since it was read",
+            headers={"ETag": f'"{model.version}"'},
+        )
+    return DessertOut.from_model(model)
+
+
+def committed(operation: OperationType, data: DessertOut, table_version: int) -> None:
+    """
+    Makes a write visible to this worker's reads right after commit,
+    without waiting for its notification to come back from the database.
+    """
+    cache.on_notification(NotificationOut(operation=operation, data=data))
+    hub.wrote(table_version)
+
+
+async def streaming_export(
+    query: DessertQuery, fmt: DataFormat, etag: str | None
+) -> Response:
+    """
+    Streams all matching rows. A page of a query with a limit is sent at once,
+    with the cursor of the next page like the JSON list.
+    """
+    try:
+        if query.cursor:
+            DessertCursor.decode(query.cursor, query)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    response: Response
+    if query.limit is None:
+        response = StreamingResponse(
+            stream_desserts(query, fmt), media_type=MEDIA_TYPES[fmt]
+        )
+    else:
+        body, next_cursor = await export_page(query, fmt)
+        response = Response(content=body, media_type=MEDIA_TYPES[fmt])
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    set_cache_headers(response, etag)
+    return response
+
+
+async def replay_frame(last_event_id: str) -> bytes:
+    """Encodes the changes a reconnecting client missed, or a resync event."""
+    try:
+        after = int(last_event_id)
+    except ValueError:
+        return RESYNC_FRAME
+    events = await replay_changes(after, conf.events.replay_max_events)
+    if events is None:
+        return RESYNC_FRAME
+    return b"".join(event.to_frame() for event in events)
+
+
+async def apply_edit(message: EditMessage) -> dict[str, Any]:
+    """Applies a cell edit sent over the WebSocket and returns the reply."""
+    changes = message.changes.changes()
+    if not changes:
+        return {"type": "error", "ref": message.ref, "detail": "No changes"}
+    versions = [message.version] if message.version is not None else None
+    try:
+        async with rt.async_session() as session:
+            conn = await session.connection()
+            result = await conn.execute(update_one(message.id, changes, versions))
+            row = result.first()
+            if row is None:
+                out = await unwritten(session, message.id, versions)
+                return {"type": "ack", "ref": message.ref, "row": encode_row(out)}
+            await session.commit()
+    except HTTPException as e:
+        return {"type": "error", "ref": message.ref, "detail": e.detail}
+    except Exception as e:
+        rt.logger.error(f"Cannot apply edit of dessert {message.id}: {e}")
+        return {"type": "error", "ref": message.ref, "detail": "Edit failed"}
+
+    out = DessertOut.model_validate(row._mapping)
+    committed(OperationType.UPDATE, out, row.table_version)
+    return {"type": "ack", "ref": message.ref, "row": encode_row(out)}
+
+
+async def write_dessert(
+    dessert_id: int, changes: dict[str, Any], request: Request, response: Response
+) -> DessertOut:
+    """
+    Updates the given fields of a dessert in one UPDATE ... RETURNING round trip.
+    Writes that would not change anything are skipped, without a notification.
+    """
+    versions = if_match_versions(request)
+    async with rt.async_session() as session:
+        if not changes:
+            out = await unwritten(session, dessert_id, versions)
+        else:
+            conn = await session.connection()
+            result = await conn.execute(update_one(dessert_id, changes, versions))
+            row = result.first()
+            if row is None:
+                out = await unwritten(session, dessert_id, versions)
+            else:
+                await session.commit()
+                out = DessertOut.model_validate(row._mapping)
+                committed(OperationType.UPDATE, out, row.table_version)
+
+    response.headers["ETag"] = out.etag
+    return out
+
+
+async def select_snapshot(
+    subscription: DessertSubscription,
+) -> list[DessertOut] | None:
+    async with rt.async_engine.connect() as conn:
+        result = await conn.execute(build_snapshot(subscription, SNAPSHOT_LIMIT))
+        rows = [DessertOut.model_validate(row._mapping) for row in result]
+    return rows if len(rows) <= SNAPSHOT_LIMIT else None
+
+
+async def select_desserts(query: DessertQuery) -> tuple[bytes, str | None]:
+    """
+    Reads plain rows, without ORM instances, and encodes them to JSON directly.
+    """
+    stmt = build_select(query).with_only_columns(*dessert_table().c)
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        result = await conn.execute(stmt)
+        page, next_cursor = paginate(result.all(), query)
+    body = DESSERT_ROWS.dump_json([row._asdict() for row in page], by_alias=True)
+    return body, next_cursor
 
 
 app = FastAPI(
@@ -25,6 +267,8 @@ app = FastAPI(
     description="Trifold is a full stack data application on Databricks",
     version=__version__,
 )
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get("/version", response_model=VersionView, operation_id="Version")
@@ -32,43 +276,108 @@ async def version():
     return get_cached_version()
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of all workers, if multiprocess mode is enabled."""
+    content, media_type = render()
+    return Response(content=content, media_type=media_type)
+
+
 @app.get("/profile", response_model=ProfileView, operation_id="Profile")
 async def profile(request: Request):
     try:
-        ws = get_user_workspace_client(request)
-        return ProfileView.from_ws(ws)
+        return ProfileView(user=await get_user_profile(request))
     except Exception as e:
-        rt.logger.error(f"Error getting user workspace client: {e}")
+        rt.logger.error(f"Error getting user profile: {e}")
         return ProfileView.from_request(request)
 
 
+@app.get("/stats/pool", response_model=list[PoolStatsView], operation_id="PoolStats")
+async def pool_stats():
+    """
+    Connection pool state of the worker serving the request.
+    Each uvicorn worker has its own pools, so sample several times to see all of them.
+    """
+    return [
+        PoolStatsView.from_pool("sync", rt.engine.pool),  # type: ignore[arg-type]
+        PoolStatsView.from_pool("async", rt.async_engine.pool),  # type: ignore[arg-type]
+    ]
+
+
 @app.get("/desserts", response_model=list[DessertOut], operation_id="Desserts")
-async def desserts() -> list[DessertOut]:
-    with rt.session() as session:
-        return [DessertOut.from_model(d) for d in session.exec(select(Dessert)).all()]
+async def desserts(request: Request, query: Annotated[DessertQuery, Query()]):
+    """
+    Lists desserts with optional filters and server-side sorting.
+    When `limit` is set and more rows are available, the cursor of the next page
+    is returned in the X-Next-Cursor header.
+    Clients sending `Accept: application/x-ndjson` get the rows streamed as NDJSON.
+    """
+    # the version must be taken before the query, so a concurrent change
+    # can only make the ETag older than the data, never newer
+    etag = table_etag()
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return not_modified(etag)
+
+    if MEDIA_TYPES[DataFormat.NDJSON] in request.headers.get("Accept", ""):
+        return await streaming_export(query, DataFormat.NDJSON, etag)
+
+    try:
+        if cache.ready:
+            page, next_cursor = cache.select(query)
+            body = DESSERT_LIST.dump_json(page)
+        else:
+            body, next_cursor = await select_desserts(query)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # returned as is, the rows were already validated when they were read
+    response = Response(content=body, media_type="application/json")
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    set_cache_headers(response, etag)
+    return response
 
 
 @app.post("/desserts", response_model=DessertOut, operation_id="CreateDessert")
-async def create_dessert(dessert: DessertIn):
-    with rt.session() as session:
-        model = Dessert.from_in(dessert)
-        session.add(model)
-        session.commit()
-        return DessertOut.from_model(model)
+async def create_dessert(dessert: DessertIn, response: Response):
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        row = (await conn.execute(insert_many([dessert]))).one()
+        await session.commit()
+
+    out = DessertOut.model_validate(row._mapping)
+    committed(OperationType.INSERT, out, row.table_version)
+    response.headers["ETag"] = out.etag
+    return out
 
 
 @app.put(
     "/desserts/{dessert_id}", response_model=DessertOut, operation_id="UpdateDessert"
 )
-async def update_dessert(dessert_id: int, dessert: DessertIn):
-    with rt.session() as session:
-        model = session.get(Dessert, dessert_id)
-        if not model:
-            raise HTTPException(status_code=404, detail="Dessert not found")
-        model.update_from_in(dessert)
-        session.commit()
-        session.refresh(model)
-        return DessertOut.from_model(model)
+async def update_dessert(
+    dessert_id: int, dessert: DessertIn, request: Request, response: Response
+):
+    """
+    Replaces a dessert in one UPDATE ... RETURNING round trip.
+    With an If-Match header the write only happens if the dessert is still
+    in that version (its ETag), otherwise it fails with 412.
+    """
+    return await write_dessert(
+        dessert_id, dessert.model_dump(by_alias=False), request, response
+    )
+
+
+@app.patch(
+    "/desserts/{dessert_id}", response_model=DessertOut, operation_id="PatchDessert"
+)
+async def patch_dessert(
+    dessert_id: int, patch: DessertPatchIn, request: Request, response: Response
+):
+    """
+    Writes only the fields present in the body, conditional like PUT with If-Match.
+    Subscribers are sent only the changed fields.
+    """
+    return await write_dessert(dessert_id, patch.changes(), request, response)
 
 
 @app.delete(
@@ -77,80 +386,268 @@ async def update_dessert(dessert_id: int, dessert: DessertIn):
     status_code=status.HTTP_204_NO_CONTENT,
     response_class=Response,
 )
-async def delete_dessert(dessert_id: int):
-    with rt.session() as session:
-        model = session.get(Dessert, dessert_id)
-        if not model:
-            raise HTTPException(status_code=404, detail="Dessert not found")
-        session.delete(model)
-        session.commit()
-        return None
+async def delete_dessert(dessert_id: int, request: Request):
+    """Deletes a dessert in one round trip, conditional like updates with If-Match."""
+    versions = if_match_versions(request)
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        row = (await conn.execute(delete_one(dessert_id, versions))).first()
+        if row is None:
+            await unwritten(session, dessert_id, versions)
+            # only reached if the dessert changed while it was being deleted
+            raise HTTPException(
+                status_code=status.HTTP_412_PRECONDITION_FAILED,
+                detail="Dessert was changed since it was read",
+            )
+        await session.commit()
+
+    out = DessertOut.model_validate(row._mapping)
+    committed(OperationType.DELETE, out, row.table_version)
+    return None
+
+
+@app.post(
+    "/desserts/{dessert_id}/reserve",
+    response_model=DessertOut,
+    operation_id="ReserveDessert",
+    responses={status.HTTP_409_CONFLICT: {"description": "Insufficient stock"}},
+)
+async def reserve_dessert(
+    dessert_id: int, reservation: ReservationIn, response: Response
+):
+    """
+    Takes `quantity` items from the stock in one conditional UPDATE.
+    Fails with 409 if not enough are left, there is no need to retry.
+    """
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        result = await conn.execute(reserve_many({dessert_id: reservation.quantity}))
+        row = result.first()
+        if row is None:
+            model = await session.get(Dessert, dessert_id)
+            if model is None:
+                raise HTTPException(status_code=404, detail="Dessert not found")
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Insufficient stock, {model.left_in_stock} left",
+            )
+        await session.commit()
+
+    out = DessertOut.model_validate(row._mapping)
+    committed(OperationType.UPDATE, out, row.table_version)
+    response.headers["ETag"] = out.etag
+    return out
 
 
 @app.get(
-    "/desserts/events",
-    operation_id="DessertsEvents",
-    response_model=list[NotificationOut],
+    "/desserts/export",
+    response_model=list[DessertOut],
+    operation_id="ExportDesserts",
+    response_class=StreamingResponse,
 )
-async def desserts_events(request: Request):
-    """Server-Sent Events endpoint for real-time dessert updates."""
-    rt.logger.info("Starting pg_event_stream")
+async def export_desserts(query: Annotated[DessertExportQuery, Query()]):
+    """Streams all desserts matching the filters as NDJSON or CSV."""
+    return await streaming_export(query, query.format, table_etag())
 
-    async def pg_event_stream() -> AsyncGenerator[str, None]:
-        rt.logger.info("Connecting to database")
-        info = rt.get_connection_info()
-        conn = None
 
-        try:
-            conn = await asyncpg.connect(
-                host=info.host,
-                port=info.port,
-                user=info.user,
-                password=info.password,
-                database=info.database,
+@app.post(
+    "/desserts:reserve",
+    response_model=ReservationBatchOut,
+    operation_id="ReserveDesserts",
+    responses={
+        status.HTTP_409_CONFLICT: {
+            "model": ReservationBatchOut,
+            "description": "Insufficient stock of some items, nothing was reserved",
+        }
+    },
+)
+async def reserve_desserts(batch: ReservationBatchIn, response: Response):
+    """
+    Reserves several desserts in one conditional UPDATE, all or nothing.
+    If any item has insufficient stock or doesn't exist the transaction is rolled
+    back and 409 is returned, with the status of every item.
+    """
+    # repeated ids are reserved together
+    quantities: dict[int, int] = {}
+    for item in batch.items:
+        quantities[item.id] = quantities.get(item.id, 0) + item.quantity
+
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        rows = (await conn.execute(reserve_many(quantities))).all()
+        reserved = {row.id: DessertOut.model_validate(row._mapping) for row in rows}
+
+        if len(reserved) == len(quantities):
+            await session.commit()
+            for out in reserved.values():
+                committed(OperationType.UPDATE, out, rows[0].table_version)
+            return ReservationBatchOut(
+                reserved=True,
+                items=[
+                    ReservationItemOut(
+                        id=dessert_id,
+                        quantity=quantity,
+                        status=ReservationStatus.RESERVED,
+                        left_in_stock=reserved[dessert_id].left_in_stock,
+                    )
+                    for dessert_id, quantity in quantities.items()
+                ],
             )
-            rt.logger.info("Connected to database")
 
-            queue: asyncio.Queue[Notification] = asyncio.Queue()
-            rt.logger.info(f"Adding listener to database on channel {NOTIFY_CHANNEL}")
+        missing = [d for d in quantities if d not in reserved]
+        stock = {
+            model.id: model.left_in_stock
+            for model in await session.exec(
+                select(Dessert).where(col(Dessert.id).in_(missing))
+            )
+        }
+        await session.rollback()
 
-            def notify_callback(_, __, ___, raw_notification: str):
-                notification = Notification.model_validate_json(raw_notification)
-                queue.put_nowait(notification)
+    def item(dessert_id: int, quantity: int) -> ReservationItemOut:
+        if dessert_id in reserved:
+            # rolled back, the stock is reported as it was before
+            left = reserved[dessert_id].left_in_stock + quantity
+            item_status = ReservationStatus.AVAILABLE
+        elif dessert_id in stock:
+            left = stock[dessert_id]
+            item_status = ReservationStatus.INSUFFICIENT_STOCK
+        else:
+            return ReservationItemOut(
+                id=dessert_id, quantity=quantity, status=ReservationStatus.NOT_FOUND
+            )
+        return ReservationItemOut(
+            id=dessert_id, quantity=quantity, status=item_status, left_in_stock=left
+        )
 
-            await conn.add_listener(NOTIFY_CHANNEL, notify_callback)
-            rt.logger.info("Listener added to database")
+    response.status_code = status.HTTP_409_CONFLICT
+    return ReservationBatchOut(
+        reserved=False,
+        items=[item(d, q) for d, q in quantities.items()],
+    )
 
-            while True:
-                # Check if client has disconnected
-                if await request.is_disconnected():
-                    rt.logger.info("Client disconnected, closing SSE stream")
-                    break
 
-                try:
-                    notification = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    yield f"data: {notification.to_out().model_dump_json()}\n\n"
-                except asyncio.TimeoutError:
-                    # Send heartbeat and check connection
-                    yield ": heartbeat\n\n"
-                except asyncio.CancelledError:
-                    rt.logger.info("SSE stream cancelled")
-                    break
-                except Exception as e:
-                    rt.logger.error(f"Error in pg_event_stream: {e}")
-                    yield f"data: error: {e}\n\n"
-                    break
+@app.post(
+    "/desserts:batch", response_model=DessertBatchOut, operation_id="BatchDesserts"
+)
+async def batch_desserts(batch: DessertBatchIn):
+    """
+    Applies creates, updates and deletes in one transaction,
+    with one multi-row statement per operation type.
+    """
+    # if an id is repeated, the last update wins
+    updates = list({item.id: item for item in batch.update}.values())
+    deletes = list(dict.fromkeys(batch.delete))
+
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        created: list[DessertOut] = []
+        updated: dict[int, DessertOut] = {}
+        deleted: dict[int, DessertOut] = {}
+        # the same for every row of the transaction
+        table_version = 0
+
+        if batch.create:
+            result = await conn.execute(insert_many(batch.create))
+            for row in result:
+                created.append(DessertOut.model_validate(row._mapping))
+                table_version = row.table_version
+        if updates:
+            result = await conn.execute(update_many(updates))
+            for row in result:
+                updated[row.id] = DessertOut.model_validate(row._mapping)
+                table_version = row.table_version
+        if deletes:
+            result = await conn.execute(delete_many(deletes))
+            for row in result:
+                deleted[row.id] = DessertOut.model_validate(row._mapping)
+                table_version = row.table_version
+
+        await session.commit()
+
+    for out in created:
+        committed(OperationType.INSERT, out, table_version)
+    for out in updated.values():
+        committed(OperationType.UPDATE, out, table_version)
+    for out in deleted.values():
+        committed(OperationType.DELETE, out, table_version)
+
+    def item(dessert_id: int, found: dict[int, DessertOut], status: BatchItemStatus):
+        if dessert_id not in found:
+            return DessertBatchItemOut(id=dessert_id, status=BatchItemStatus.NOT_FOUND)
+        return DessertBatchItemOut(id=dessert_id, status=status, data=found[dessert_id])
+
+    return DessertBatchOut(
+        created=[
+            DessertBatchItemOut(id=out.id, status=BatchItemStatus.CREATED, data=out)
+            for out in created
+        ],
+        updated=[item(u.id, updated, BatchItemStatus.UPDATED) for u in updates],
+        deleted=[item(d, deleted, BatchItemStatus.DELETED) for d in deletes],
+    )
+
+
+@app.post(
+    "/desserts:import",
+    response_model=DessertImportOut,
+    operation_id="ImportDesserts",
+)
+async def import_desserts_from_body(
+    request: Request,
+    format: DataFormat = DataFormat.NDJSON,
+    mode: ImportMode = ImportMode.INSERT,
+):
+    """
+    Bulk loads desserts from a CSV or NDJSON request body using COPY.
+    The body is streamed, so uploads of any size use constant memory.
+    """
+    try:
+        result, table_version = await import_desserts(request.stream(), format, mode)
+    except ImportRowError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    hub.wrote(table_version)
+    return result
+
+
+@app.get(
+    "/desserts/events",
+    operation_id="DessertsEvents",
+    response_model=list[NotificationOut | BulkChangeOut],
+)
+async def desserts_events(request: Request):
+    """
+    Server-Sent Events endpoint for real-time dessert updates.
+    Row changes are sent as default `message` events, statements changing many rows
+    as named `bulk` events listing the changed ids, to be refetched by the client.
+    Clients falling too far behind get a named `resync` event and should refetch.
+    Events carry ids, clients reconnecting with Last-Event-ID get the missed changes.
+    """
+    rt.logger.info("Starting pg_event_stream")
+    last_event_id = request.headers.get("Last-Event-ID")
+
+    async def pg_event_stream() -> AsyncGenerator[bytes, None]:
+        try:
+            # subscribe first, so no change falls between the replay and live events
+            async with hub.subscribe() as subscriber:
+                if last_event_id:
+                    replayed = await replay_frame(last_event_id)
+                    if replayed:
+                        yield replayed
+                while True:
+                    # Check if client has disconnected
+                    if await request.is_disconnected():
+                        rt.logger.info("Client disconnected, closing SSE stream")
+                        break
 
+                    try:
+                        yield await asyncio.wait_for(subscriber.get(), timeout=30.0)
+                    except asyncio.TimeoutError:
+                        # Send heartbeat and check connection
+                        yield HEARTBEAT_FRAME
         except asyncio.CancelledError:
-            rt.logger.info("SSE stream cancelled during setup")
+            rt.logger.info("SSE stream cancelled")
         except Exception as e:
             rt.logger.error(f"Error in pg_event_stream: {e}")
-            yield f"data: error: {e}\n\n"
-
-        finally:
-            if conn:
-                await conn.close()
-                rt.logger.info("Database connection closed")
+            yield f"data: error: {e}\n\n".encode()
 
     return StreamingResponse(
         pg_event_stream(),
@@ -164,4 +661,123 @@ async def desserts_events(request: Request):
     )
 
 
+@app.websocket("/desserts/ws")
+async def desserts_ws(websocket: WebSocket):
+    """
+    Two-way delta sync of a filtered slice of the table.
+    Clients send `{"type": "subscribe", "filter": {...}}` and get a snapshot of the
+    matching rows, followed by `delta` messages with only the changes to the slice:
+    `["U", *row]` to insert or replace a row, `["D", id]` to remove it.
+    Cell edits are sent as `{"type": "edit", "ref": ..., "id": ..., "changes": {...}}`
+    and answered with an `ack` or `error` carrying the same ref.
+    """
+    await websocket.accept()
+    session = DeltaSession()
+    subscriptions: list[DessertSubscription] = []
+    send_lock = asyncio.Lock()
+
+    async def send(message: dict[str, Any]) -> None:
+        async with send_lock:
+            await websocket.send_text(json.dumps(message, separators=(",", ":")))
+
+    async with hub.watch() as watcher:
+
+        async def load_snapshot() -> None:
+            assert session.subscription is not None
+            # changes from before the snapshot are part of it
+            watcher.drain()
+            rows = await select_snapshot(session.subscription)
+            if rows is None:
+                session.subscription = None
+                await send(
+                    {
+                        "type": "error",
+                        "detail": f"Filter matches more than {SNAPSHOT_LIMIT} desserts",
+                    }
+                )
+                return
+            await send(session.snapshot(rows))
+
+        async def sync() -> None:
+            # the only task touching the session, so deltas never race a snapshot
+            while True:
+                events = await watcher.get()
+                if subscriptions:
+                    session.subscribe(subscriptions[-1])
+                    subscriptions.clear()
+                    await load_snapshot()
+                elif session.subscription is None:
+                    continue
+                elif events is None or session.needs_snapshot(events):
+                    await load_snapshot()
+                elif deltas := session.deltas(events):
+                    await send({"type": "delta", "events": deltas})
+
+        async def pump() -> None:
+            try:
+                await sync()
+            except Exception as e:
+                # the client would silently stop getting changes, it has to
+                # reconnect and subscribe again for a fresh snapshot
+                rt.logger.error(f"Error in WebSocket delta sync: {e}")
+                try:
+                    await send({"type": "error", "detail": "Delta sync failed"})
+                    await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+                except Exception as close_error:
+                    # the socket itself may be what failed
+                    rt.logger.debug(f"Cannot close WebSocket: {close_error}")
+
+        pump_task = asyncio.create_task(pump())
+        try:
+            while True:
+                raw = await websocket.receive_text()
+                try:
+                    message = ClientMessage.validate_json(raw)
+                except ValidationError as e:
+                    await send({"type": "error", "detail": str(e)})
+                    continue
+
+                if isinstance(message, SubscribeMessage):
+                    subscriptions.append(message.filter)
+                    # wakes up the pump, which loads the snapshot
+                    watcher.push([])
+                else:
+                    await send(await apply_edit(message))
+        except WebSocketDisconnect:
+            rt.logger.info("WebSocket client disconnected")
+        finally:
+            pump_task.cancel()
+            try:
+                await pump_task
+            except asyncio.CancelledError:
+                pass
+
+
+@app.get("/desserts/{dessert_id}", response_model=DessertOut, operation_id="Dessert")
+async def dessert(dessert_id: int, request: Request, response: Response):
+    """
+    Served from the cache, the ETag is the row version, which can be sent back
+    in If-Match. Otherwise it is the table version, so conditional requests are
+    answered without a query until the table changes.
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if cache.ready:
+        out = cache.get(dessert_id)
+        etag = out.etag if out is not None else None
+    else:
+        etag = table_etag()
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        async with rt.async_session() as session:
+            model = await session.get(Dessert, dessert_id)
+            out = DessertOut.from_model(model) if model else None
+
+    if out is None:
+        raise HTTPException(status_code=404, detail="Dessert not found")
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    set_cache_headers(response, etag)
+    return out
+
+
 app.openapi = partial(custom_openapi, app)
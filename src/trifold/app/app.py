@@ -1,13 +1,15 @@
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request
 
 from trifold import __version__
 from trifold.app.api import app as api_app
+from trifold.app.cache import cache
 from trifold.app.config import conf, rt
 from trifold.app.database import create_db_and_tables
+from trifold.app.hub import hub
+from trifold.app.metrics import mark_process_dead
+from trifold.app.static import PrecompressedStaticFiles
 
 
 @asynccontextmanager
@@ -17,12 +19,17 @@ async def lifespan(app: FastAPI):  # noqa: ARG001
     rt.logger.info(f"Starting the application with version {__version__}")
     rt.logger.info(f"App config: {conf.model_dump_json(indent=2)}")
     create_db_and_tables()
+    if conf.cache.enabled:
+        hub.attach(cache)
+    await hub.start()
     yield
+    await hub.stop()
+    mark_process_dead()
 
 
 app = FastAPI(title="Trifold", lifespan=lifespan)
 
-ui_app = StaticFiles(directory=conf.static_assets_path, html=True)
+ui_app = PrecompressedStaticFiles(directory=conf.static_assets_path, html=True)
 
 
 # note the order of mounts!
@@ -32,5 +39,5 @@ app.mount("/", ui_app)
 
 
 @app.exception_handler(404)
-async def client_side_routing(_, __):
-    return FileResponse(conf.static_assets_path / "index.html")
+async def client_side_routing(request: Request, _):
+    return ui_app.index.response(request.headers)
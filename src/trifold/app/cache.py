@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterable
+
+import asyncpg
+
+from trifold.app.config import conf, rt
+from trifold.app.models import DessertOut, DessertQuery, DessertSortField, SortOrder
+from trifold.app.notify import NotificationOut, OperationType
+from trifold.app.queries import DessertCursor, InvalidCursorError, matches, paginate
+
+LOAD_QUERY = """
+SELECT id, name, price, description, left_in_stock, version
+FROM dessert
+ORDER BY id
+LIMIT $1
+"""
+
+SortIndex = tuple[list[tuple[Any, int]], list[DessertOut]]
+
+
+class DessertCache:
+    """
+    In-memory materialized copy of the dessert table, one per worker.
+    It is loaded on every listener (re)connect and kept current by applying the
+    rows of the notifications, as sent by the trigger or fetched by the hub. Reads are only served while the
+    listener is connected, since changes made in between would be missed.
+
+    Sort indexes are built on first use and then updated in place for every
+    changed row. Text columns are ordered by code point, as the database orders
+    them for the list query, so cursors work across cached and uncached workers.
+    """
+
+    def __init__(self, max_rows: int) -> None:
+        self.max_rows = max_rows
+        self._rows: dict[int, DessertOut] = {}
+        self._indexes: dict[DessertSortField, SortIndex] = {}
+        self._pending: list[NotificationOut] | None = None
+        self._ready = False
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    @property
+    def size(self) -> int:
+        return len(self._rows)
+
+    async def on_connect(self, conn: asyncpg.Connection) -> None:
+        self._reset()
+        # notifications received before the snapshot are already part of it,
+        # those received while it is loading are replayed on top in commit order
+        self._pending = []
+        try:
+            records = await conn.fetch(LOAD_QUERY, self.max_rows + 1)
+            if len(records) > self.max_rows:
+                rt.logger.warning(
+                    f"Dessert table exceeds {self.max_rows} rows, cache disabled"
+                )
+                return
+
+            self._rows = {r["id"]: DessertOut.model_validate(dict(r)) for r in records}
+            for notification in self._pending:
+                self._apply(notification)
+            self._ready = True
+            self._check_bounds()
+        finally:
+            self._pending = None
+
+        if self._ready:
+            rt.logger.info(f"Dessert cache loaded with {self.size} rows")
+
+    def on_notification(self, notification: NotificationOut) -> None:
+        if self._pending is not None:
+            self._pending.append(notification)
+        elif self._ready:
+            self._apply(notification)
+            self._check_bounds()
+
+    def on_disconnect(self) -> None:
+        self._reset()
+
+    def get(self, dessert_id: int) -> DessertOut | None:
+        return self._rows.get(dessert_id)
+
+    def select(self, query: DessertQuery) -> tuple[list[DessertOut], str | None]:
+        """In-memory counterpart of `build_select` followed by `paginate`."""
+        keys, rows = self._index(query.sort_by)
+
+        candidates: Iterable[int]
+        desc = query.order == SortOrder.DESC
+        if query.cursor:
+            cursor = DessertCursor.decode(query.cursor, query)
+            bound = (cursor.value, cursor.id)
+            try:
+                if desc:
+                    candidates = reversed(range(bisect_left(keys, bound)))
+                else:
+                    candidates = range(bisect_right(keys, bound), len(rows))
+            except TypeError as e:
+                raise InvalidCursorError("Cursor value doesn't match sort key") from e
+        else:
+            candidates = reversed(range(len(rows))) if desc else range(len(rows))
+
+        found: list[DessertOut] = []
+        for i in candidates:
+            if matches(query, rows[i]):
+                found.append(rows[i])
+                if query.limit is not None and len(found) > query.limit:
+                    break
+
+        page, next_cursor = paginate(found, query)
+        return list(page), next_cursor
+
+    def _index(self, field: DessertSortField) -> SortIndex:
+        index = self._indexes.get(field)
+        if index is None:
+            column = field.column_name
+            rows = sorted(self._rows.values(), key=lambda r: (getattr(r, column), r.id))
+            index = ([(getattr(r, column), r.id) for r in rows], rows)
+            self._indexes[field] = index
+        return index
+
+    def _apply(self, notification: NotificationOut) -> None:
+        data = notification.data
+        if notification.operation == OperationType.DELETE:
+            old = self._rows.pop(data.id, None)
+            new = None
+        elif isinstance(data, DessertOut):
+            old = self._rows.get(data.id)
+            new = self._rows[data.id] = data
+        else:
+            return
+        for field, index in self._indexes.items():
+            self._reindex(field.column_name, index, old, new)
+
+    @staticmethod
+    def _reindex(
+        column: str, index: SortIndex, old: DessertOut | None, new: DessertOut | None
+    ) -> None:
+        """Moves a changed row within a sort index, by bisection."""
+        keys, rows = index
+        if old is not None:
+            i = bisect_left(keys, (getattr(old, column), old.id))
+            if new is not None and getattr(new, column) == getattr(old, column):
+                rows[i] = new
+                return
+            del keys[i], rows[i]
+        if new is not None:
+            key = (getattr(new, column), new.id)
+            i = bisect_left(keys, key)
+            keys.insert(i, key)
+            rows.insert(i, new)
+
+    def _check_bounds(self) -> None:
+        if self.size > self.max_rows:
+            rt.logger.warning(
+                f"Dessert cache grew over {self.max_rows} rows, disabled until reconnect"
+            )
+            self._reset()
+
+    def _reset(self) -> None:
+        self._ready = False
+        self._rows = {}
+        self._indexes.clear()
+
+
+cache = DessertCache(max_rows=conf.cache.max_rows)
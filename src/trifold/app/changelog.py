@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from pydantic.alias_generators import to_camel
+from sqlmodel import col, func, select
+
+from trifold.app.config import rt
+from trifold.app.models import Dessert, DessertChange, DessertOut
+from trifold.app.notify import DessertKey, NotificationOut, OperationType
+
+# Sequence numbers are taken when a row changes, not when the transaction commits,
+# so a change with a lower number may become visible after a client saw a higher one.
+# Replays start this many entries early; replayed events are idempotent.
+REPLAY_OVERLAP = 100
+
+# the latest entry is always kept, so a client that saw it is known to be current
+TRIM_QUERY = """
+DELETE FROM dessert_change
+WHERE created_at < now() - make_interval(mins => $1)
+  AND seq < (SELECT max(seq) FROM dessert_change)
+"""
+
+
+async def replay_changes(after: int, max_events: int) -> list[NotificationOut] | None:
+    """
+    Returns the changes made after the `after` sequence number, one event per
+    dessert with its current state, ordered by the last change of each dessert.
+    None means the client has to refetch, since the changes were already trimmed
+    from the log or there are more than `max_events` of them.
+    """
+    async with rt.async_session() as session:
+        first = (await session.exec(select(func.min(DessertChange.seq)))).one()
+        if first is not None and after < first - 1:
+            return None
+
+        changes = (
+            await session.exec(
+                select(DessertChange)
+                .where(col(DessertChange.seq) > max(after - REPLAY_OVERLAP, 0))
+                .order_by(col(DessertChange.seq))
+                .limit(max_events + 1)
+            )
+        ).all()
+        if len(changes) > max_events:
+            return None
+
+        ids = {c.dessert_id for c in changes}
+        rows = {
+            d.id: DessertOut.from_model(d)
+            for d in (
+                await session.exec(select(Dessert).where(col(Dessert.id).in_(ids)))
+            ).all()
+        }
+
+    first_op: dict[int, OperationType] = {}
+    last_seq: dict[int, int] = {}
+    changed: dict[int, list[str] | None] = {}
+    for change in changes:
+        assert change.seq is not None
+        op = OperationType(change.operation)
+        dessert_id = change.dessert_id
+        if dessert_id not in first_op:
+            first_op[dessert_id] = op
+            changed[dessert_id] = change.changed
+        elif op == OperationType.UPDATE and change.changed is not None:
+            previous = changed[dessert_id]
+            changed[dessert_id] = (
+                list(dict.fromkeys([*previous, *change.changed]))
+                if previous is not None
+                else None
+            )
+        else:
+            changed[dessert_id] = None
+        last_seq[dessert_id] = change.seq
+
+    events: list[NotificationOut] = []
+    for dessert_id, seq in sorted(last_seq.items(), key=lambda item: item[1]):
+        row = rows.get(dessert_id)
+        if row is None:
+            events.append(
+                NotificationOut(
+                    operation=OperationType.DELETE,
+                    data=DessertKey(id=dessert_id),
+                    seq=seq,
+                )
+            )
+        elif first_op[dessert_id] == OperationType.INSERT:
+            events.append(
+                NotificationOut(operation=OperationType.INSERT, data=row, seq=seq)
+            )
+        else:
+            fields = changed[dessert_id]
+            events.append(
+                NotificationOut(
+                    operation=OperationType.UPDATE,
+                    data=row,
+                    changed=[to_camel(c) for c in fields] if fields else None,
+                    seq=seq,
+                )
+            )
+    return events
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+from datetime import datetime, timedelta, timezone
+from enum import Enum
 from functools import cached_property
 import logging
 from logging import Logger
 from pathlib import Path
+import re
+import threading
+from typing import Any, Callable
 import uuid
 
 from databricks.sdk import WorkspaceClient
@@ -11,10 +16,22 @@ from databricks.sdk import WorkspaceClient
 from dotenv import load_dotenv
 from pydantic import BaseModel, ConfigDict, Field, SecretStr, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from sqlalchemy import Engine
+from sqlalchemy import URL, Engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from trifold.app.utils import TimedCachedProperty, configure_consistent_logging
+from trifold.app.metrics import instrument_engine
+from trifold.app.pool import (
+    InstrumentedAsyncAdaptedQueuePool,
+    InstrumentedQueuePool,
+    instrument_pool,
+)
+from trifold.app.utils import (
+    AsyncTimedCachedProperty,
+    TimedCachedProperty,
+    configure_consistent_logging,
+)
 
 configure_consistent_logging()
 
@@ -35,11 +52,115 @@ class DatabaseConfig(BaseModel):
     instance_name: str = Field(default="trifold")
     port: int = Field(default=5432)
     database: str = Field(default="databricks_postgres")
+    pool_size: int = Field(
+        default=2, ge=1, description="Connections kept open per engine and worker"
+    )
+    max_overflow: int = Field(
+        default=0,
+        ge=0,
+        description="Extra connections opened under load on top of pool_size",
+    )
+    pool_timeout: float = Field(
+        default=30.0,
+        gt=0,
+        description="Seconds to wait for a free connection before failing",
+    )
+    pool_recycle: int = Field(
+        default=45 * 60,
+        description="Seconds after which a connection is replaced, -1 to disable",
+    )
+    pool_pre_ping: bool = Field(
+        default=False,
+        description=(
+            "Test connections for liveness on checkout, at the cost of a round trip "
+            "per checkout; pool_recycle already replaces them before the token expires"
+        ),
+    )
+
+
+class CacheConfig(BaseModel):
+    enabled: bool = Field(
+        default=False,
+        description="Serve dessert list reads from an in-memory copy of the table",
+    )
+    max_rows: int = Field(
+        default=50_000,
+        description="Upper bound on cached rows, larger tables are read from the database",
+    )
+
+
+class NotifyPayload(str, Enum):
+    FULL = "full"
+    COMPACT = "compact"
+
+
+class NotifyLevel(str, Enum):
+    ROW = "row"
+    STATEMENT = "statement"
+
+
+class NotifyConfig(BaseModel):
+    payload: NotifyPayload = Field(
+        default=NotifyPayload.FULL,
+        description=(
+            "Whether the notify trigger sends whole rows, or only their ids and "
+            "changed columns, with the rows fetched in batches by each listener"
+        ),
+    )
+    level: NotifyLevel = Field(
+        default=NotifyLevel.ROW,
+        description=(
+            "Whether the trigger fires per row, or per statement with transition tables"
+        ),
+    )
+    bulk_threshold: int = Field(
+        default=100,
+        ge=0,
+        description=(
+            "In statement mode, statements changing more rows send bulk events "
+            "with the changed ids instead of one event per row"
+        ),
+    )
+
+
+class EventsConfig(BaseModel):
+    coalesce_window_ms: int = Field(
+        default=50,
+        ge=0,
+        description=(
+            "Changes sent to SSE clients are batched for this long, "
+            "with changes of the same dessert merged into one event"
+        ),
+    )
+    max_backlog_bytes: int = Field(
+        default=1_000_000,
+        gt=0,
+        description=(
+            "Unsent events kept per SSE client, a client falling further behind "
+            "gets a resync event instead"
+        ),
+    )
+    replay_retention_minutes: int = Field(
+        default=60,
+        gt=0,
+        description="Age after which entries are trimmed from the change log",
+    )
+    replay_max_events: int = Field(
+        default=10_000,
+        gt=0,
+        description=(
+            "Reconnecting SSE clients that missed more changes get a resync event "
+            "instead of a replay"
+        ),
+    )
 
 
 class AppConfig(BaseSettings):
     model_config = SettingsConfigDict(
-        env_file=env_file, env_prefix="TRIFOLD_", extra="allow"
+        env_file=env_file,
+        env_prefix="TRIFOLD_",
+        env_nested_delimiter="__",
+        extra="allow",
     )
 
     static_assets_path: Path = Field(
@@ -53,6 +174,9 @@ class AppConfig(BaseSettings):
     )
 
     db: DatabaseConfig = Field(default_factory=DatabaseConfig)
+    cache: CacheConfig = Field(default_factory=CacheConfig)
+    notify: NotifyConfig = Field(default_factory=NotifyConfig)
+    events: EventsConfig = Field(default_factory=EventsConfig)
 
 
 class ConnectionInfo(BaseModel):
@@ -62,14 +186,108 @@ class ConnectionInfo(BaseModel):
     password: str
     database: str
 
-    def to_url(self) -> str:
-        return f"postgresql://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}?sslmode=require"
+    def to_url(self, drivername: str = "postgresql") -> URL:
+        """
+        Returns the engine URL without the password.
+        The password is a short-lived token supplied for every new connection.
+        """
+        return URL.create(
+            drivername,
+            username=self.user,
+            host=self.host,
+            port=self.port,
+            database=self.database,
+        )
+
+
+class DatabaseCredentials:
+    """
+    Short-lived Lakebase token shared by all connections of the process.
+    A new token is minted in a background thread `refresh_margin` before the
+    current one expires, so opening a connection never waits on the Databricks API
+    (except for the very first one, or if the background refresh kept failing).
+    """
+
+    def __init__(
+        self,
+        mint: Callable[[], tuple[str, datetime]],
+        refresh_margin: timedelta = timedelta(minutes=10),
+        retry_interval: timedelta = timedelta(seconds=30),
+    ) -> None:
+        self.mint = mint
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._token: str | None = None
+        self._expires_at: datetime | None = None
+        self._timer: threading.Timer | None = None
+
+    @property
+    def expires_at(self) -> datetime | None:
+        return self._expires_at
+
+    def token(self) -> str:
+        token, expires_at = self._token, self._expires_at
+        if (
+            token is None
+            or expires_at is None
+            or datetime.now(timezone.utc) >= expires_at
+        ):
+            return self.refresh()
+        return token
+
+    def refresh(self, force: bool = False) -> str:
+        with self._lock:
+            if not force and self._token is not None and not self._expiring():
+                # another thread refreshed it while we were waiting for the lock
+                return self._token
+
+            token, expires_at = self.mint()
+            self._token, self._expires_at = token, expires_at
+            logger.info(f"Minted new database token, expires at {expires_at}")
+            self._schedule(expires_at - self.refresh_margin)
+            return token
+
+    def _expiring(self) -> bool:
+        assert self._expires_at is not None
+        return datetime.now(timezone.utc) >= self._expires_at - self.refresh_margin
+
+    def _schedule(self, at: datetime) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max((at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self) -> None:
+        try:
+            self.refresh(force=True)
+        except Exception as e:
+            logger.error(f"Background database token refresh failed: {e}")
+            with self._lock:
+                self._schedule(datetime.now(timezone.utc) + self.retry_interval)
+
+
+def parse_expiration(value: str | None) -> datetime:
+    """Parses the token expiration time, assuming the documented 1 hour if unknown."""
+    fallback = datetime.now(timezone.utc) + timedelta(hours=1)
+    if not value:
+        return fallback
+    try:
+        # the API may return nanoseconds, which datetime cannot represent
+        parsed = datetime.fromisoformat(re.sub(r"(\.\d{6})\d+", r"\1", value))
+    except ValueError:
+        return fallback
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed
 
 
 class Runtime(BaseModel):
     conf: AppConfig
 
-    model_config = ConfigDict(ignored_types=(TimedCachedProperty,))
+    model_config = ConfigDict(
+        ignored_types=(TimedCachedProperty, AsyncTimedCachedProperty)
+    )
 
     @cached_property
     def logger(self) -> Logger:
@@ -82,54 +300,121 @@ class Runtime(BaseModel):
         """
         return WorkspaceClient()
 
-    def get_connection_info(self) -> ConnectionInfo:
+    def mint_database_token(self) -> tuple[str, datetime]:
+        cred = self.ws.database.generate_database_credential(
+            request_id=str(uuid.uuid4()), instance_names=[self.conf.db.instance_name]
+        )
+        assert cred.token is not None, "Password is not found"
+        return cred.token, parse_expiration(cred.expiration_time)
+
+    @cached_property
+    def credentials(self) -> DatabaseCredentials:
+        return DatabaseCredentials(self.mint_database_token)
+
+    @TimedCachedProperty[str](ttl_seconds=6 * 60 * 60, stale_while_revalidate=True)
+    def database_host(self) -> str:
         """
-        Returns the SQLAlchemy engine URL used for database operations.
-        This URL is initialized with the database URL and can be used to create sessions.
-        The URL is cached for 30 minutes to improve performance while ensuring
-        credentials are refreshed periodically.
+        Returns the DNS name of the Lakebase instance.
+        It practically never changes, so it is cached for hours and refreshed in the background.
         """
         instance = self.ws.database.get_database_instance(
             name=self.conf.db.instance_name
         )
-        cred = self.ws.database.generate_database_credential(
-            request_id=str(uuid.uuid4()), instance_names=[self.conf.db.instance_name]
-        )
+        assert instance.read_write_dns is not None, "Host is not found"
+        return instance.read_write_dns
+
+    @TimedCachedProperty[str](ttl_seconds=6 * 60 * 60, stale_while_revalidate=True)
+    def database_user(self) -> str:
+        """
+        Returns the user name of the service principal, used as the database role.
+        """
         user = self.ws.current_user.me().user_name
-        pwd = cred.token
-        host = instance.read_write_dns
-        assert host is not None, "Host is not found"
         assert user is not None, "User is not found"
-        assert pwd is not None, "Password is not found"
+        return user
 
+    def invalidate_connection_info(self) -> None:
+        """
+        Drops the cached host and user, e.g. after the instance was recreated.
+        """
+        Runtime.database_host.invalidate(self)
+        Runtime.database_user.invalidate(self)
+
+    def get_connection_info(self) -> ConnectionInfo:
+        """
+        Returns the connection parameters of the Lakebase instance.
+        Host and user are cached, the password is the current database token,
+        so in the common case no Databricks API call is made.
+        """
         return ConnectionInfo(
-            host=host,
+            host=self.database_host,
             port=self.conf.db.port,
-            user=user,
-            password=pwd,
+            user=self.database_user,
+            password=self.credentials.token(),
             database=self.conf.db.database,
         )
 
-    @TimedCachedProperty[Engine](ttl_seconds=30 * 60)  # 30 minutes
+    def _inject_token(
+        self, _dialect: Any, _conn_rec: Any, _cargs: Any, cparams: dict[str, Any]
+    ) -> None:
+        # called by SQLAlchemy for every new physical connection
+        cparams["password"] = self.credentials.token()
+
+    def pool_options(self) -> dict[str, Any]:
+        db = self.conf.db
+        return dict(
+            pool_size=db.pool_size,
+            max_overflow=db.max_overflow,
+            pool_timeout=db.pool_timeout,
+            pool_recycle=db.pool_recycle,
+            pool_pre_ping=db.pool_pre_ping,
+        )
+
+    @cached_property
     def engine(self) -> Engine:
         """
         Returns the SQLAlchemy engine used for database operations.
-        This engine is initialized with the database URL and can be used to create sessions.
-        The engine is cached for 30 minutes to improve performance while ensuring
-        credentials are refreshed periodically.
+        The engine is created once, a fresh token is injected for every new connection.
+        Pooled connections are recycled, each one at its own age,
+        so they are replaced gradually and never all at once.
+        Pool sizing comes from the database config, the pool is instrumented.
         """
-        self.logger.info("Creating new SQLAlchemy engine (cache expired or first time)")
-        return create_engine(
-            self.get_connection_info().to_url(),
+        self.logger.info("Creating SQLAlchemy engine")
+        engine = create_engine(
+            self.get_connection_info().to_url("postgresql+psycopg2"),
             # echo=True,
-            pool_size=2,
-            max_overflow=0,
+            poolclass=InstrumentedQueuePool,
+            **self.pool_options(),
+            connect_args={"sslmode": "require"},
         )
+        event.listen(engine, "do_connect", self._inject_token)
+        instrument_pool(engine)
+        instrument_engine(engine)
+        return engine
+
+    @cached_property
+    def async_engine(self) -> AsyncEngine:
+        """
+        Returns the asyncpg-backed SQLAlchemy engine used by the API handlers.
+        Queries issued through this engine do not block the event loop.
+        Tokens, recycling and pool settings work the same way as for the synchronous engine.
+        """
+        self.logger.info("Creating async SQLAlchemy engine")
+        engine = create_async_engine(
+            self.get_connection_info().to_url("postgresql+asyncpg"),
+            poolclass=InstrumentedAsyncAdaptedQueuePool,
+            **self.pool_options(),
+            # asyncpg does not understand sslmode
+            connect_args={"ssl": "require"},
+        )
+        event.listen(engine.sync_engine, "do_connect", self._inject_token)
+        instrument_pool(engine.sync_engine)
+        instrument_engine(engine.sync_engine)
+        return engine
 
     @model_validator(mode="after")
     def validate_conf(self) -> Runtime:
         try:
-            self.ws.current_user.me()
+            assert self.database_user, "Service principal has no user name"
             assert self.engine is not None, "Engine is not initialized"
         except Exception as e:
             self.logger.error(
@@ -143,11 +428,17 @@ class Runtime(BaseModel):
         """
         Returns the SQLModel session used for database operations.
         This session is initialized with the engine and can be used to create transactions.
-        The session is cached for 30 minutes to improve performance while ensuring
-        credentials are refreshed periodically.
         """
         return Session(self.engine)
 
+    def async_session(self) -> AsyncSession:
+        """
+        Returns the async SQLModel session used by the API handlers.
+        Objects are not expired on commit, so they can be serialized
+        after the transaction without an implicit refresh round trip.
+        """
+        return AsyncSession(self.async_engine, expire_on_commit=False)
+
 
 conf = AppConfig()
 rt = Runtime(conf=conf)
@@ -1,21 +1,182 @@
+import hashlib
+from typing import Callable
+
+from sqlalchemy import DDL, Connection, func, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.schema import CreateTable
 from sqlmodel import SQLModel
 
-from trifold.app.config import rt
-from trifold.app.notify import notify_function, notify_trigger
+from trifold.app.config import conf, rt
+from trifold.app.models import SchemaVersion
+from trifold.app.notify import notify_ddl
 
+# same key in every worker, only one of them migrates while the others wait
+MIGRATION_LOCK_KEY = 0x7472_6966_6F6C_64
+
+# columns added after the first release, create_all leaves existing tables alone
+dessert_columns = [
+    DDL(
+        "ALTER TABLE dessert "
+        "ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1"
+    ),
+]
+
+# The version is owned by the database, so every writer (psql, imports, other
+# services) invalidates the If-Match preconditions of the API, not only its own writes
+dessert_triggers = [
+    DDL(
+        """
+CREATE OR REPLACE FUNCTION bump_dessert_version() RETURNS trigger AS $func$
+BEGIN
+  -- explicit writes of the version are ignored, updates changing nothing keep it
+  NEW.version := OLD.version;
+  IF NEW IS DISTINCT FROM OLD THEN
+    NEW.version := OLD.version + 1;
+  END IF;
+  RETURN NEW;
+END;
+$func$ LANGUAGE plpgsql;
+"""
+    ),
+    DDL(
+        """
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_trigger
+    WHERE tgname = 'desserts_version_trigger'
+  ) THEN
+    CREATE TRIGGER desserts_version_trigger
+    BEFORE UPDATE ON dessert
+    FOR EACH ROW EXECUTE FUNCTION bump_dessert_version();
+  END IF;
+END
+$$;
+"""
+    ),
+]
+
+# the trigger only updates the counter, its row has to exist before the first write
+dessert_rows = [
+    DDL(
+        "INSERT INTO dessert_table_version (id, version) VALUES (1, 0) "
+        "ON CONFLICT (id) DO NOTHING"
+    ),
+]
+
+# Keyset pagination walks (sort_key, id) ranges, prefix filters need pattern ops.
+# Text keys are sorted in the "C" collation, see TEXT_SORT_COLLATION
+dessert_indexes = [
+    DDL("DROP INDEX IF EXISTS ix_dessert_name_id"),
+    DDL(
+        "CREATE INDEX IF NOT EXISTS ix_dessert_name_c_id "
+        'ON dessert (name COLLATE "C", id)'
+    ),
+    DDL("CREATE INDEX IF NOT EXISTS ix_dessert_price_id ON dessert (price, id)"),
+    DDL(
+        "CREATE INDEX IF NOT EXISTS ix_dessert_left_in_stock_id "
+        "ON dessert (left_in_stock, id)"
+    ),
+    DDL(
+        "CREATE INDEX IF NOT EXISTS ix_dessert_name_prefix "
+        "ON dessert (name text_pattern_ops)"
+    ),
+    # the change log is append-only, a BRIN index is enough for trimming by age
+    DDL(
+        "CREATE INDEX IF NOT EXISTS ix_dessert_change_created_at "
+        "ON dessert_change USING brin (created_at)"
+    ),
+]
+
+
+def fingerprint(statements: list[str]) -> str:
+    return hashlib.sha256("\n".join(statements).encode()).hexdigest()[:16]
+
+
+def schema_statements() -> list[str]:
+    dialect = postgresql.dialect()
+    tables = [
+        str(CreateTable(table).compile(dialect=dialect))
+        for table in SQLModel.metadata.sorted_tables
+    ]
+    return [*tables, *(ddl.statement for ddl in schema_ddl())]
+
+
+def schema_ddl() -> list[DDL]:
+    return [*dessert_columns, *dessert_triggers, *dessert_rows, *dessert_indexes]
 
-def create_db_and_tables():
-    rt.logger.info("Creating database and tables...")
-    SQLModel.metadata.create_all(rt.engine)
-    rt.logger.info("Database and tables created successfully.")
 
-    rt.logger.info("Creating notify function and trigger...")
+def apply_schema(conn: Connection) -> None:
+    SQLModel.metadata.create_all(conn)
+    for ddl in schema_ddl():
+        conn.execute(ddl)
+
+
+def apply_notify(conn: Connection) -> None:
+    rt.logger.info(
+        f"Creating notify functions and {conf.notify.level.value} level triggers "
+        f"({conf.notify.payload.value} payload)..."
+    )
+    for ddl in notify_ddl(conf.notify):
+        conn.execute(ddl)
+
+
+def applied_versions(conn: Connection) -> dict[str, str]:
+    result = conn.execute(select(SchemaVersion.component, SchemaVersion.version))
+    return {component: version for component, version in result}
+
+
+def create_db_and_tables():
+    """
+    Brings the schema and the notify triggers up to date, once per change.
+    Each component is fingerprinted by the DDL it would run (which depends on the
+    notify config too), and only applied if the fingerprint recorded in
+    schema_version differs. Workers starting together serialize on an advisory lock,
+    the ones that get it after the migration find everything current.
+    """
+    components: dict[str, tuple[str, Callable[[Connection], None]]] = {
+        "schema": (fingerprint(schema_statements()), apply_schema),
+        "notify": (
+            fingerprint([ddl.statement for ddl in notify_ddl(conf.notify)]),
+            apply_notify,
+        ),
+    }
 
     with rt.engine.connect() as conn:
-        conn.execute(notify_function)
-        conn.execute(notify_trigger)
-        conn.commit()
+        try:
+            applied = applied_versions(conn)
+        except ProgrammingError:
+            # first start, schema_version doesn't exist yet
+            applied = {}
+        conn.rollback()
+
+        if all(applied.get(name) == v for name, (v, _) in components.items()):
+            rt.logger.info("Database schema is up to date.")
+            return
 
-    rt.logger.info("Notify function and trigger created successfully.")
+        rt.logger.info("Waiting for the schema migration lock...")
+        # held until commit, DDL is transactional in Postgres
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+        )
+        SchemaVersion.__table__.create(conn, checkfirst=True)  # type: ignore[attr-defined]
+        applied = applied_versions(conn)
+
+        for name, (version, apply) in components.items():
+            if applied.get(name) == version:
+                rt.logger.info(f"Database {name} is up to date.")
+                continue
+            rt.logger.info(f"Applying database {name} version {version}...")
+            apply(conn)
+            conn.execute(
+                postgresql.insert(SchemaVersion)
+                .values(component=name, version=version)
+                .on_conflict_do_update(
+                    index_elements=["component"],
+                    set_={"version": version, "applied_at": func.now()},
+                )
+            )
+        conn.commit()
 
     rt.logger.info("Database initialized successfully.")
@@ -1,29 +1,70 @@
+import asyncio
+from dataclasses import dataclass
+import hashlib
+
 from databricks.sdk import WorkspaceClient
+from databricks.sdk.service import iam
 from fastapi import Request
 
 from trifold.app.config import rt, conf
+from trifold.app.utils import TTLCache
 
 
-def get_user_workspace_client(
-    request: Request,
-) -> WorkspaceClient:
-    """
-    Returns a Databricks Workspace client with authentication behalf of user.
-    If the request contains an X-Forwarded-Access-Token header, on behalf of user authentication is used.
-    Otherwise, the client is created using the default environemnt variables (e.g. during local development)
-    """
-    token = (
-        request.headers.get("X-Forwarded-Access-Token")
-        or conf.dev_token.get_secret_value()
-        if conf.dev_token
-        else None
+@dataclass
+class UserSession:
+    key: str
+    client: WorkspaceClient
+    user: iam.User | None = None
+
+
+# keyed by a hash of the token, so raw tokens are never kept as dict keys;
+# entries live shorter than OBO tokens, so expired tokens fall out on their own
+user_sessions: TTLCache[str, UserSession] = TTLCache(
+    "user_sessions", maxsize=1024, ttl_seconds=5 * 60
+)
+
+
+def get_user_token(request: Request) -> str:
+    token = request.headers.get("X-Forwarded-Access-Token") or (
+        conf.dev_token.get_secret_value() if conf.dev_token else None
     )
     if not token:
         raise ValueError(
             "No token for authentication provided in request headers or environment variables"
         )
+    return token
+
 
-    rt.logger.info("Received OBO token, initializing client with it")
-    return WorkspaceClient(
-        token=token, auth_type="pat"
-    )  # set pat explicitly to avoid issues with SP client
+def token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_user_session(request: Request) -> UserSession:
+    token = get_user_token(request)
+    key = token_key(token)
+    session = user_sessions.get(key)
+    if session is None:
+        rt.logger.info("Received new OBO token, initializing client with it")
+        session = UserSession(
+            key=key,
+            # set pat explicitly to avoid issues with SP client
+            client=WorkspaceClient(token=token, auth_type="pat"),
+        )
+        user_sessions.set(key, session)
+    return session
+
+
+async def get_user_profile(request: Request) -> iam.User:
+    """
+    Returns the user behind the request token.
+    The user is resolved once per cached token, the blocking SDK call runs in a thread.
+    """
+    session = get_user_session(request)
+    if session.user is None:
+        try:
+            session.user = await asyncio.to_thread(session.client.current_user.me)
+        except Exception:
+            # most likely an expired or revoked token, don't keep it around
+            user_sessions.pop(session.key)
+            raise
+    return session.user
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import csv
+import io
+from typing import AsyncIterator, Callable, Sequence
+
+from sqlalchemy import Row
+
+from trifold.app.config import rt
+from trifold.app.models import DessertOut, DessertQuery, DataFormat
+from trifold.app.queries import build_select, dessert_table, paginate
+
+MEDIA_TYPES = {
+    DataFormat.NDJSON: "application/x-ndjson",
+    DataFormat.CSV: "text/csv",
+}
+
+CSV_HEADER = [
+    DessertOut.model_fields[c.name].alias or c.name for c in dessert_table().c
+]
+
+
+def encode_header(fmt: DataFormat) -> bytes:
+    if fmt != DataFormat.CSV:
+        return b""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(CSV_HEADER)
+    return buffer.getvalue().encode()
+
+
+def encode_ndjson(rows: Sequence[Row]) -> bytes:
+    return b"".join(
+        DessertOut.model_validate(row._mapping).model_dump_json().encode() + b"\n"
+        for row in rows
+    )
+
+
+def encode_csv(rows: Sequence[Row]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+ENCODERS: dict[DataFormat, Callable[[Sequence[Row]], bytes]] = {
+    DataFormat.NDJSON: encode_ndjson,
+    DataFormat.CSV: encode_csv,
+}
+
+
+async def export_page(query: DessertQuery, fmt: DataFormat) -> tuple[bytes, str | None]:
+    """
+    Encodes one page of a query with a limit, returning the cursor of the next one.
+    Pages are small, and the cursor has to be known before the body is sent.
+    """
+    stmt = build_select(query).with_only_columns(*dessert_table().c)
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        rows = (await conn.execute(stmt)).all()
+    page, next_cursor = paginate(rows, query)
+    return encode_header(fmt) + ENCODERS[fmt](page), next_cursor
+
+
+async def stream_desserts(
+    query: DessertQuery, fmt: DataFormat, chunk_size: int = 1000
+) -> AsyncIterator[bytes]:
+    """
+    Streams the rows matching the query through a server-side cursor.
+    Every fetched chunk is encoded and written out before the next one is read,
+    so memory usage doesn't depend on the number of rows.
+    A limit is applied without the look-ahead row, export_page also
+    returns the cursor of the next page.
+    """
+    stmt = build_select(query).with_only_columns(*dessert_table().c)
+    if query.limit is not None:
+        stmt = stmt.limit(query.limit)
+    encode = ENCODERS[fmt]
+
+    header = encode_header(fmt)
+    if header:
+        yield header
+
+    async with rt.async_session() as session:
+        conn = await session.connection()
+        result = await conn.stream(stmt)
+        rows = 0
+        async for partition in result.partitions(chunk_size):
+            rows += len(partition)
+            yield encode(partition)
+
+    rt.logger.info(f"Streamed {rows} desserts as {fmt.value}")
@@ -0,0 +1,478 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Protocol
+
+import asyncpg
+from pydantic import ValidationError
+
+from trifold.app.changelog import TRIM_QUERY
+from trifold.app.config import conf, rt
+from trifold.app.metrics import (
+    NOTIFICATION_LAG,
+    NOTIFICATIONS_DELIVERED,
+    NOTIFICATIONS_RECEIVED,
+    SSE_RESYNCS,
+    SSE_SUBSCRIBERS,
+)
+from trifold.app.models import DessertOut
+from trifold.app.notify import (
+    NOTIFY_CHANNEL,
+    BulkChange,
+    BulkChangeOut,
+    DessertKey,
+    Notification,
+    NotificationOut,
+    OperationType,
+    sse_frame,
+)
+
+FETCH_QUERY = """
+SELECT id, name, price, description, left_in_stock, version
+FROM dessert
+WHERE id = ANY($1::integer[])
+"""
+
+TABLE_VERSION_QUERY = "SELECT coalesce(max(version), 0) FROM dessert_table_version"
+
+# tells a client that fell behind to drop its state and refetch
+RESYNC_FRAME = sse_frame("{}", event="resync")
+
+# row events are coalesced per (segment, dessert id), bulk events are kept as is
+PendingKey = tuple[int, int] | tuple[str, int]
+
+
+class Subscriber:
+    """
+    Bounded backlog of encoded frames of one SSE client.
+    If the client is too slow to keep it under `max_backlog_bytes`,
+    the backlog is dropped and replaced by a resync event.
+    """
+
+    def __init__(self, max_backlog_bytes: int) -> None:
+        self.max_backlog_bytes = max_backlog_bytes
+        self._frames: deque[tuple[bytes, int]] = deque()
+        self._size = 0
+        self._ready = asyncio.Event()
+
+    def push(self, frame: bytes, events: int) -> None:
+        if self._size + len(frame) > self.max_backlog_bytes:
+            rt.logger.warning(
+                f"Subscriber backlog exceeded {self.max_backlog_bytes} bytes, "
+                "sending resync"
+            )
+            SSE_RESYNCS.inc()
+            self._frames.clear()
+            self._size = 0
+            frame, events = RESYNC_FRAME, 0
+        self._frames.append((frame, events))
+        self._size += len(frame)
+        self._ready.set()
+
+    async def get(self) -> bytes:
+        """Waits for frames and returns all of them, to be written at once."""
+        await self._ready.wait()
+        frames, self._frames = self._frames, deque()
+        self._size = 0
+        self._ready.clear()
+        NOTIFICATIONS_DELIVERED.inc(sum(events for _, events in frames))
+        return b"".join(frame for frame, _ in frames)
+
+
+class HubListener(Protocol):
+    """Worker-local consumer of the notification stream (e.g. the read cache)."""
+
+    async def on_connect(self, conn: asyncpg.Connection) -> None:
+        """Called after every (re)connect, once LISTEN is active."""
+
+    def on_notification(self, notification: NotificationOut) -> None:
+        """Called for every decoded notification, before it is sent to subscribers."""
+
+    def on_disconnect(self) -> None:
+        """Called when the listener connection is lost and changes may be missed."""
+
+
+class Watcher:
+    """
+    Bounded backlog of coalesced events, for consumers that filter them
+    (e.g. WebSocket subscriptions). A consumer too slow to keep it under
+    `max_backlog_events` loses the backlog and has to resync.
+    """
+
+    def __init__(self, max_backlog_events: int) -> None:
+        self.max_backlog_events = max_backlog_events
+        self._events: list[NotificationOut | BulkChangeOut] = []
+        self._overflowed = False
+        self._ready = asyncio.Event()
+
+    def push(self, events: list[NotificationOut | BulkChangeOut]) -> None:
+        if len(self._events) + len(events) > self.max_backlog_events:
+            SSE_RESYNCS.inc()
+            self._events = []
+            self._overflowed = True
+        elif not self._overflowed:
+            self._events.extend(events)
+        self._ready.set()
+
+    def drain(self) -> None:
+        """Drops the backlog, e.g. before loading a fresh snapshot."""
+        self._events = []
+        self._overflowed = False
+        self._ready.clear()
+
+    async def get(self) -> list[NotificationOut | BulkChangeOut] | None:
+        """Waits for events and returns all of them, or None after an overflow."""
+        await self._ready.wait()
+        events, overflowed = self._events, self._overflowed
+        self.drain()
+        return None if overflowed else events
+
+
+class NotificationHub:
+    """
+    Worker-level broadcaster for database notifications.
+    A single LISTEN connection is shared by all SSE subscribers of the worker.
+    Events are collected for `coalesce_window` seconds, with multiple changes of
+    the same dessert merged into one event. Each batch is encoded into SSE frames
+    exactly once, and the same bytes are pushed to every subscriber.
+    Rows of compact notifications are fetched on the listener connection,
+    with one query per batch of notifications received meanwhile.
+    """
+
+    def __init__(
+        self,
+        channel: str,
+        health_check_interval: float = 30.0,
+        max_backoff: float = 30.0,
+        coalesce_window: float = 0.05,
+        max_backlog_bytes: int = 1_000_000,
+        max_backlog_events: int = 10_000,
+        retention_minutes: int = 60,
+        trim_interval: float = 300.0,
+    ) -> None:
+        self.channel = channel
+        self.health_check_interval = health_check_interval
+        self.max_backoff = max_backoff
+        self.retention_minutes = retention_minutes
+        self.trim_interval = trim_interval
+        self.coalesce_window = coalesce_window
+        self.max_backlog_bytes = max_backlog_bytes
+        self.max_backlog_events = max_backlog_events
+        self._subscribers: set[Subscriber] = set()
+        self._watchers: set[Watcher] = set()
+        self._pending: dict[PendingKey, NotificationOut | BulkChangeOut] = {}
+        self._segment = 0
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._listeners: list[HubListener] = []
+        self._task: asyncio.Task[None] | None = None
+        # table version of the latest change seen, None while not known
+        self._version: int | None = None
+        # table version of the latest write of this worker
+        self._written = 0
+        # compact notifications waiting for their rows, and those queued behind them
+        self._inbox: list[Notification] = []
+        self._fetcher: asyncio.Task[None] | None = None
+        # the listener connection also runs queries, one at a time
+        self._conn_lock = asyncio.Lock()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def table_version(self) -> int | None:
+        """
+        Version of the table as seen by this worker, or None while not known.
+        It is the table version carried by the last notification received, a
+        counter the notify trigger bumps in commit order, so it never goes back
+        and workers that have seen the same changes report the same version.
+        """
+        if self._version is None or self._version < self._written:
+            return None
+        return self._version
+
+    def attach(self, listener: HubListener) -> None:
+        self._listeners.append(listener)
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        rt.logger.info(f"Starting notification hub on channel {self.channel}")
+        self._task = asyncio.create_task(self._run(), name="notification-hub")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        rt.logger.info("Stopping notification hub")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._flush()
+
+    @asynccontextmanager
+    async def subscribe(self) -> AsyncIterator[Subscriber]:
+        """
+        Registers a new subscriber for the lifetime of the context.
+        The subscriber receives pre-encoded SSE frames.
+        """
+        subscriber = Subscriber(self.max_backlog_bytes)
+        self._subscribers.add(subscriber)
+        SSE_SUBSCRIBERS.inc()
+        rt.logger.info(f"Subscriber added, total: {self.subscriber_count}")
+        try:
+            yield subscriber
+        finally:
+            self._subscribers.discard(subscriber)
+            SSE_SUBSCRIBERS.dec()
+            rt.logger.info(f"Subscriber removed, total: {self.subscriber_count}")
+
+    @asynccontextmanager
+    async def watch(self) -> AsyncIterator[Watcher]:
+        """
+        Registers a watcher for the lifetime of the context.
+        Unlike subscribers, watchers receive the coalesced events themselves.
+        """
+        watcher = Watcher(self.max_backlog_events)
+        self._watchers.add(watcher)
+        try:
+            yield watcher
+        finally:
+            self._watchers.discard(watcher)
+
+    def wrote(self, table_version: int) -> None:
+        """
+        Withholds the table version until the notification of a write of this
+        worker comes back. Its rows are read from the cache right after commit,
+        so a client reading its own write back never gets a stale 304.
+        """
+        self._written = max(self._written, table_version)
+
+    def _advance(self, table_version: int | None) -> None:
+        # only the last chunk of a bulk change carries its table version
+        if table_version is None:
+            return
+        # notifications of changes older than the version read on connect still arrive
+        self._version = max(self._version or 0, table_version)
+
+    def publish(self, out: NotificationOut | BulkChangeOut) -> None:
+        """Queues an event for the next batch sent to the subscribers."""
+        if isinstance(out, BulkChangeOut):
+            # row events are never merged across a bulk change, to keep their order
+            self._segment += 1
+            self._pending[("bulk", self._segment)] = out
+            self._segment += 1
+        else:
+            key = (self._segment, out.data.id)
+            previous = self._pending.pop(key, None)
+            merged = (
+                previous.merge(out) if isinstance(previous, NotificationOut) else out
+            )
+            if merged is not None:
+                self._pending[key] = merged
+
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.coalesce_window, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        events = list(pending.values())
+        for watcher in self._watchers:
+            watcher.push(events)
+        if self._subscribers:
+            frame = b"".join(out.to_frame() for out in events)
+            for subscriber in self._subscribers:
+                subscriber.push(frame, events=len(events))
+
+    def _on_notification(
+        self, conn: asyncpg.Connection, _pid: int, _channel: str, payload: str
+    ) -> None:
+        NOTIFICATIONS_RECEIVED.inc()
+        try:
+            notification = Notification.model_validate_json(payload)
+        except ValidationError as e:
+            # the change it was sent for is unknown, so is the version
+            self._version = None
+            rt.logger.error(f"Cannot decode notification payload: {e}")
+            return
+
+        if notification.sent_at is not None:
+            # relies on the database and app clocks being in sync (NTP)
+            lag = datetime.now(timezone.utc) - notification.sent_at
+            NOTIFICATION_LAG.observe(max(lag.total_seconds(), 0.0))
+
+        if self._inbox or self._fetch_ids(notification):
+            # later notifications wait behind the ones being fetched, to keep commit order
+            self._inbox.append(notification)
+            if self._fetcher is None or self._fetcher.done():
+                self._fetcher = asyncio.create_task(self._fetch_pending(conn))
+            return
+
+        self._dispatch(notification, {})
+
+    def _fetch_ids(self, notification: Notification) -> list[int]:
+        if notification.needs_fetch:
+            return [notification.dessert_id]
+        # rows of bulk changes are only needed by listeners, subscribers refetch
+        bulk = notification.bulk
+        if bulk and notification.operation != OperationType.DELETE and self._listeners:
+            return bulk.ids
+        return []
+
+    def _dispatch(
+        self, notification: Notification, rows: dict[int, DessertOut]
+    ) -> None:
+        if notification.bulk is None:
+            self._deliver(
+                notification.to_out(rows.get(notification.dessert_id)),
+                notification.table_version,
+            )
+        else:
+            self._deliver_bulk(notification, notification.bulk, rows)
+
+    def _deliver(self, out: NotificationOut | None, table_version: int | None) -> None:
+        if out is not None:
+            for listener in self._listeners:
+                listener.on_notification(out)
+            self.publish(out)
+        # advanced only once listeners (the cache) are up to date
+        self._advance(table_version)
+
+    def _deliver_bulk(
+        self, notification: Notification, bulk: BulkChange, rows: dict[int, DessertOut]
+    ) -> None:
+        """
+        Listeners still get one event per row, subscribers a single named
+        `bulk` event per chunk, so their default message handlers are not flooded.
+        """
+        if self._listeners:
+            for dessert_id in bulk.ids:
+                data: DessertOut | DessertKey | None = (
+                    DessertKey(id=dessert_id)
+                    if notification.operation == OperationType.DELETE
+                    else rows.get(dessert_id)
+                )
+                if data is None:
+                    continue
+                out = NotificationOut(operation=notification.operation, data=data)
+                for listener in self._listeners:
+                    listener.on_notification(out)
+
+        self.publish(
+            BulkChangeOut.from_bulk(notification.operation, bulk, seq=notification.seq)
+        )
+        self._advance(notification.table_version)
+
+    async def _fetch_pending(self, conn: asyncpg.Connection) -> None:
+        """
+        Fetches the rows of compact and bulk notifications, once per batch of
+        pending ones, and delivers the batch in the order it was received.
+        Rows may be newer than the notification, never older.
+        """
+        while self._inbox:
+            batch, self._inbox = self._inbox, []
+            ids = list({i for n in batch for i in self._fetch_ids(n)})
+            rows: dict[int, DessertOut] = {}
+            if ids:
+                try:
+                    async with self._conn_lock:
+                        records = await conn.fetch(FETCH_QUERY, ids)
+                except Exception as e:
+                    rt.logger.error(f"Cannot fetch notified desserts: {e}")
+                    # changes would be lost, reconnect so listeners reload their state
+                    self._inbox = []
+                    conn.terminate()
+                    return
+                rows = {r["id"]: DessertOut.model_validate(dict(r)) for r in records}
+
+            for notification in batch:
+                self._dispatch(notification, rows)
+
+    async def _run(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                await self._listen()
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                rt.logger.error(f"Notification listener failed: {e}")
+                # the instance may have moved, look it up again on reconnect
+                rt.invalidate_connection_info()
+
+            rt.logger.info(f"Reconnecting notification listener in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _trim(self, conn: asyncpg.Connection) -> None:
+        async with self._conn_lock:
+            status = await conn.execute(TRIM_QUERY, self.retention_minutes)
+        rt.logger.debug(f"Trimmed change log: {status}")
+
+    async def _listen(self) -> None:
+        info = await asyncio.to_thread(rt.get_connection_info)
+        conn: asyncpg.Connection = await asyncpg.connect(
+            host=info.host,
+            port=info.port,
+            user=info.user,
+            password=info.password,
+            database=info.database,
+        )
+        closed = asyncio.Event()
+        conn.add_termination_listener(lambda _: closed.set())
+
+        try:
+            await conn.add_listener(self.channel, self._on_notification)
+            rt.logger.info(f"Listening for notifications on channel {self.channel}")
+            async with self._conn_lock:
+                # taken before the listeners load their state, so it is never newer
+                # than the data; changes notified meanwhile advance it
+                self._version = await conn.fetchval(TABLE_VERSION_QUERY)
+                for listener in self._listeners:
+                    await listener.on_connect(conn)
+
+            loop = asyncio.get_running_loop()
+            trimmed_at = loop.time()
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(
+                        closed.wait(), timeout=self.health_check_interval
+                    )
+                except asyncio.TimeoutError:
+                    # detect half-open connections that never fire termination
+                    async with self._conn_lock:
+                        await conn.execute("SELECT 1")
+                    if loop.time() - trimmed_at >= self.trim_interval:
+                        await self._trim(conn)
+                        trimmed_at = loop.time()
+        finally:
+            # changes may be missed while the listener is down
+            self._version = None
+            if self._fetcher is not None:
+                self._fetcher.cancel()
+                self._fetcher = None
+            self._inbox = []
+            for listener in self._listeners:
+                listener.on_disconnect()
+            if not conn.is_closed():
+                await conn.close()
+            rt.logger.info("Notification listener connection closed")
+
+
+hub = NotificationHub(
+    NOTIFY_CHANNEL,
+    coalesce_window=conf.events.coalesce_window_ms / 1000,
+    max_backlog_bytes=conf.events.max_backlog_bytes,
+    retention_minutes=conf.events.replay_retention_minutes,
+)
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import csv
+import time
+from typing import Any, AsyncIterator
+
+import asyncpg
+from pydantic import ValidationError
+
+from trifold.app.config import rt
+from trifold.app.models import (
+    DessertImportOut,
+    DessertImportRow,
+    DataFormat,
+    ImportMode,
+)
+
+# loading a million rows should take seconds, slower imports are logged
+TARGET_ROWS_PER_SECOND = 100_000
+
+COLUMNS = ["id", "name", "price", "description", "left_in_stock"]
+
+STAGING_TABLE = "dessert_import"
+
+create_staging_table = f"""
+CREATE TEMP TABLE {STAGING_TABLE} (
+    ord bigint,
+    id integer,
+    name varchar,
+    price double precision,
+    description varchar,
+    left_in_stock integer
+) ON COMMIT DROP
+"""
+
+# with repeated ids the last row of the upload wins
+upsert_from_staging = f"""
+INSERT INTO dessert (id, name, price, description, left_in_stock)
+SELECT DISTINCT ON (id) id, name, price, description, left_in_stock
+FROM {STAGING_TABLE}
+ORDER BY id, ord DESC
+ON CONFLICT (id) DO UPDATE SET
+    name = EXCLUDED.name,
+    price = EXCLUDED.price,
+    description = EXCLUDED.description,
+    left_in_stock = EXCLUDED.left_in_stock
+"""
+
+# COPY has no RETURNING, the version of the import is taken before its commit
+bump_table_version = "SELECT bump_dessert_table_version()"
+
+# explicit ids bypass the serial sequence, move it past them
+sync_id_sequence = """
+SELECT setval(
+    pg_get_serial_sequence('dessert', 'id'),
+    GREATEST((SELECT max(id) FROM dessert), 1)
+)
+"""
+
+
+class ImportRowError(ValueError):
+    """Raised when a row of the upload cannot be parsed or validated."""
+
+
+def decode_line(line: bytes, line_no: int) -> str:
+    try:
+        return line.decode().rstrip("\r")
+    except UnicodeDecodeError as e:
+        raise ImportRowError(f"Line {line_no}: not valid UTF-8 ({e.reason})") from e
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    tail = b""
+    line_no = 0
+    async for chunk in chunks:
+        *lines, tail = (tail + chunk).split(b"\n")
+        for line in lines:
+            line_no += 1
+            yield decode_line(line, line_no)
+    if tail:
+        yield decode_line(tail, line_no + 1)
+
+
+async def parse_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[DessertImportRow]:
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            yield DessertImportRow.model_validate_json(line)
+        except ValidationError as e:
+            raise ImportRowError(f"Line {line_no}: {e}") from e
+
+
+async def parse_csv(lines: AsyncIterator[str]) -> AsyncIterator[DessertImportRow]:
+    """
+    Parses CSV with a header row, accepting both camelCase and snake_case names.
+    Quoted values may span several lines.
+    """
+    header: list[str] | None = None
+    record = ""
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        record = f"{record}\n{line}" if record else line
+        # an odd number of quotes means a quoted value continues on the next line
+        if record.count('"') % 2:
+            continue
+
+        values = next(csv.reader([record]), [])
+        record = ""
+        if not values:
+            continue
+        if header is None:
+            header = values
+            continue
+
+        data: dict[str, Any] = dict(zip(header, values))
+        if not data.get("id"):
+            data.pop("id", None)
+        try:
+            yield DessertImportRow.model_validate(data)
+        except ValidationError as e:
+            raise ImportRowError(f"Line {line_no}: {e}") from e
+
+    if record:
+        raise ImportRowError(f"Line {line_no}: unterminated quoted value")
+
+
+PARSERS = {
+    DataFormat.NDJSON: parse_ndjson,
+    DataFormat.CSV: parse_csv,
+}
+
+
+async def import_desserts(
+    chunks: AsyncIterator[bytes], fmt: DataFormat, mode: ImportMode
+) -> tuple[DessertImportOut, int]:
+    """
+    Loads the uploaded rows with COPY ... FROM STDIN in a single transaction.
+    Inserts are copied straight into the table, upserts go through a temporary
+    staging table and a single INSERT ... ON CONFLICT statement.
+    Any invalid row aborts the whole import.
+    Returns the table version of the import along with its stats.
+    """
+    rows = PARSERS[fmt](iter_lines(chunks))
+    count = 0
+
+    async def insert_records() -> AsyncIterator[tuple[Any, ...]]:
+        nonlocal count
+        async for row in rows:
+            count += 1
+            yield (row.name, row.price, row.description, row.left_in_stock)
+
+    async def staging_records() -> AsyncIterator[tuple[Any, ...]]:
+        nonlocal count
+        async for row in rows:
+            count += 1
+            if row.id is None:
+                raise ImportRowError(f"Row {count}: id is required for upserts")
+            yield (
+                count,
+                row.id,
+                row.name,
+                row.price,
+                row.description,
+                row.left_in_stock,
+            )
+
+    start = time.perf_counter()
+    async with rt.async_engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        driver: asyncpg.Connection = raw.driver_connection  # type: ignore[assignment]
+
+        async with driver.transaction():
+            if mode == ImportMode.INSERT:
+                await driver.copy_records_to_table(
+                    "dessert", records=insert_records(), columns=COLUMNS[1:]
+                )
+            else:
+                await driver.execute(create_staging_table)
+                await driver.copy_records_to_table(
+                    STAGING_TABLE, records=staging_records(), columns=["ord", *COLUMNS]
+                )
+                await driver.execute(upsert_from_staging)
+                await driver.execute(sync_id_sequence)
+            table_version: int = await driver.fetchval(bump_table_version)
+    seconds = time.perf_counter() - start
+
+    rate = count / seconds if seconds else float(count)
+    rt.logger.info(f"Imported {count} desserts ({mode.value}) at {rate:.0f} rows/s")
+    if count >= TARGET_ROWS_PER_SECOND and rate < TARGET_ROWS_PER_SECOND:
+        rt.logger.warning(
+            f"Import rate {rate:.0f} rows/s is below the target of "
+            f"{TARGET_ROWS_PER_SECOND} rows/s"
+        )
+
+    out = DessertImportOut(mode=mode, rows=count, seconds=seconds, rows_per_second=rate)
+    return out, table_version
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Any
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import Engine, event
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# With several uvicorn workers, PROMETHEUS_MULTIPROC_DIR must point to an empty
+# directory shared by all of them (set before start, see databricks.yml), the
+# values are then aggregated across workers on every scrape.
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+REQUEST_DURATION = Histogram(
+    "trifold_http_request_duration_seconds",
+    "Duration of API requests until the last byte of the response",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "trifold_http_requests_in_flight",
+    "API requests currently being processed",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+SQL_DURATION = Histogram(
+    "trifold_sql_duration_seconds",
+    "Duration of SQL statements executed through the SQLAlchemy engines",
+    ["statement"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0),
+)
+SSE_SUBSCRIBERS = Gauge(
+    "trifold_sse_subscribers",
+    "Connected SSE subscribers",
+    multiprocess_mode="livesum",
+)
+SSE_RESYNCS = Counter(
+    "trifold_sse_resyncs",
+    "Resyncs of SSE and WebSocket clients whose backlog was dropped",
+)
+NOTIFICATIONS_RECEIVED = Counter(
+    "trifold_notifications_received",
+    "Notifications received from the database",
+)
+NOTIFICATIONS_DELIVERED = Counter(
+    "trifold_notifications_delivered",
+    "Notification events written to SSE subscribers",
+)
+NOTIFICATION_LAG = Histogram(
+    "trifold_notification_lag_seconds",
+    "Time from the change in the database until the notification is received",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+CACHE_EVENTS = Counter(
+    "trifold_cache_events",
+    "Lookups and removals of in-process caches, by outcome",
+    ["cache", "event"],
+)
+
+STATEMENT_TYPES = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def render() -> tuple[bytes, str]:
+    """Returns the exposition of all metrics, aggregated over workers if enabled."""
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead() -> None:
+    """
+    Drops the live gauges of this worker from the aggregated values.
+    Called on worker shutdown, the other metrics of the worker are kept.
+    """
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def statement_type(statement: str) -> str:
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in STATEMENT_TYPES else "OTHER"
+
+
+def _before_cursor_execute(
+    _conn: Any, _cursor: Any, _statement: str, _params: Any, context: Any, _many: bool
+) -> None:
+    context._trifold_started = time.perf_counter()
+
+
+def _after_cursor_execute(
+    _conn: Any, _cursor: Any, statement: str, _params: Any, context: Any, _many: bool
+) -> None:
+    started = getattr(context, "_trifold_started", None)
+    if started is not None:
+        SQL_DURATION.labels(statement_type(statement)).observe(
+            time.perf_counter() - started
+        )
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Times every statement executed through the engine, by statement type."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """
+    Records latency and in-flight requests per route template, so path parameters
+    don't create new label values. SSE streams are long-lived by design, they are
+    counted as in flight but left out of the latency histogram.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = self._route(scope)
+        status = 500
+        streaming = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = dict(message.get("headers", []))
+                streaming = headers.get(b"content-type", b"").startswith(
+                    b"text/event-stream"
+                )
+            await send(message)
+
+        in_flight = REQUESTS_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            if not streaming:
+                REQUEST_DURATION.labels(method, route, str(status)).observe(
+                    time.perf_counter() - start
+                )
+
+    def _route(self, scope: Scope) -> str:
+        app = scope.get("app")
+        router = getattr(app, "router", None)
+        for route in getattr(router, "routes", []):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "unmatched")
+        return "unmatched"
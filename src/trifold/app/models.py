@@ -1,15 +1,29 @@
 from __future__ import annotations
 
+from datetime import datetime
+from enum import Enum
 from functools import lru_cache
+from typing import Any
 
-from databricks.sdk import WorkspaceClient
 from databricks.sdk.service import iam
 from fastapi import Request
 from trifold import __version__
 
-from pydantic import BaseModel, ConfigDict
-from pydantic.alias_generators import to_camel
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    TypeAdapter,
+    model_validator,
+    with_config,
+)
+from pydantic.alias_generators import to_camel, to_snake
+from sqlalchemy import ARRAY, BigInteger, Column, DateTime, Text, func
+from sqlalchemy.pool import QueuePool
 from sqlmodel import SQLModel, Field as SQLField
+from typing_extensions import TypedDict
+
+from trifold.app.pool import PoolStats
 
 
 class CamelModel(BaseModel):
@@ -35,10 +49,6 @@ def get_cached_version() -> VersionView:
 class ProfileView(CamelModel):
     user: iam.User
 
-    @classmethod
-    def from_ws(cls, ws: WorkspaceClient) -> "ProfileView":
-        return cls(user=ws.current_user.me())
-
     @classmethod
     def from_request(cls, request: Request) -> "ProfileView":
         # make user from request headers, all other fields are None
@@ -63,21 +73,65 @@ class Dessert(SQLModel, table=True):
     price: float
     description: str
     left_in_stock: int = SQLField(default=0)
+    # bumped by a trigger on every update, exposed as the ETag of the row
+    version: int = SQLField(default=1, sa_column_kwargs={"server_default": "1"})
+
+
+class DessertChange(SQLModel, table=True):
+    """
+    Change log written by the notify trigger, one entry per changed row.
+    Only ids are kept, missed changes are replayed with the current rows.
+    """
+
+    __tablename__ = "dessert_change"
+
+    seq: int | None = SQLField(
+        default=None,
+        sa_column=Column(BigInteger, primary_key=True, autoincrement=True),
+    )
+    operation: str
+    dessert_id: int
+    changed: list[str] | None = SQLField(default=None, sa_column=Column(ARRAY(Text)))
+    created_at: datetime | None = SQLField(
+        default=None,
+        sa_column=Column(
+            DateTime(timezone=True), server_default=func.now(), nullable=False
+        ),
+    )
 
-    @classmethod
-    def from_in(cls, in_: DessertIn) -> Dessert:
-        return cls(
-            name=in_.name,
-            price=in_.price,
-            description=in_.description,
-            left_in_stock=in_.left_in_stock,
-        )
 
-    def update_from_in(self, in_: DessertIn) -> None:
-        self.name = in_.name
-        self.price = in_.price
-        self.description = in_.description
-        self.left_in_stock = in_.left_in_stock
+class DessertTableVersion(SQLModel, table=True):
+    """
+    Single-row counter bumped by the notify trigger on every change.
+    Writers hold its row lock until they commit, so unlike the change log
+    sequence it grows in commit order.
+    """
+
+    __tablename__ = "dessert_table_version"
+
+    id: int = SQLField(default=1, primary_key=True)
+    version: int = SQLField(
+        default=0,
+        sa_column=Column(BigInteger, nullable=False, server_default="0"),
+    )
+
+
+class SchemaVersion(SQLModel, table=True):
+    """
+    Fingerprints of the DDL applied to the database, one row per component.
+    Workers skip the schema bootstrap when they match the DDL they would run.
+    """
+
+    __tablename__ = "schema_version"
+
+    component: str = SQLField(primary_key=True)
+    version: str
+    applied_at: datetime | None = SQLField(
+        default=None,
+        sa_column=Column(
+            DateTime(timezone=True), server_default=func.now(), nullable=False
+        ),
+    )
 
 
 class DessertOut(CamelModel):
@@ -86,6 +140,7 @@ class DessertOut(CamelModel):
     price: float
     description: str
     left_in_stock: int
+    version: int
 
     @classmethod
     def from_model(cls, model: Dessert) -> DessertOut:
@@ -96,4 +151,241 @@ class DessertOut(CamelModel):
             price=model.price,
             description=model.description,
             left_in_stock=model.left_in_stock,
+            version=model.version,
         )
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+
+@with_config(ConfigDict(alias_generator=to_camel))
+class DessertRow(TypedDict):
+    """
+    Wire format of DessertOut for plain database rows.
+    Lists of rows are serialized straight to JSON, without a model per row.
+    Dump with by_alias=True, TypedDicts don't pick it up from the config.
+    """
+
+    id: int
+    name: str
+    price: float
+    description: str
+    left_in_stock: int
+    version: int
+
+
+# schemas are built once, serialization then runs in pydantic-core
+DESSERT_ROWS = TypeAdapter(list[DessertRow])
+DESSERT_LIST = TypeAdapter(list[DessertOut])
+
+
+class SortOrder(str, Enum):
+    ASC = "asc"
+    DESC = "desc"
+
+
+class DessertSortField(str, Enum):
+    """Sort keys of the list endpoint, each one backed by a (key, id) index."""
+
+    ID = "id"
+    NAME = "name"
+    PRICE = "price"
+    LEFT_IN_STOCK = "leftInStock"
+
+    @property
+    def column_name(self) -> str:
+        return to_snake(self.value)
+
+
+class DataFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+class ImportMode(str, Enum):
+    INSERT = "insert"
+    UPSERT = "upsert"
+
+
+class DessertImportRow(DessertIn):
+    """Row of a bulk import. The id is required for upserts and ignored for inserts."""
+
+    id: int | None = None
+
+
+class DessertImportOut(CamelModel):
+    mode: ImportMode
+    rows: int
+    seconds: float
+    rows_per_second: float
+
+
+class DessertFilter(CamelModel):
+    name_prefix: str | None = None
+    min_price: float | None = None
+    max_price: float | None = None
+    min_stock: int | None = None
+    max_stock: int | None = None
+
+
+class DessertQuery(DessertFilter):
+    """
+    Query parameters of the dessert list endpoint.
+    Pagination is keyset-based: the cursor encodes the (sort key, id) pair
+    of the last returned row, so every page is an index range scan.
+    """
+
+    limit: int | None = Field(default=None, ge=1, le=1000)
+    cursor: str | None = None
+    sort_by: DessertSortField = DessertSortField.ID
+    order: SortOrder = SortOrder.ASC
+
+
+class DessertExportQuery(DessertQuery):
+    """Query parameters of the export endpoint, the list filters and a format."""
+
+    format: DataFormat = DataFormat.NDJSON
+
+
+class DessertSubscription(DessertFilter):
+    """Slice of the table a WebSocket client wants to be kept in sync with."""
+
+    ids: list[int] | None = Field(default=None, max_length=10_000)
+
+
+class DessertPatchIn(CamelModel):
+    """Sparse update, only the fields that are set are written."""
+
+    name: str | None = None
+    price: float | None = None
+    description: str | None = None
+    left_in_stock: int | None = None
+
+    @model_validator(mode="after")
+    def check_not_null(self) -> DessertPatchIn:
+        # None only means "not set", the columns themselves are not nullable
+        nulls = [
+            to_camel(name)
+            for name in self.model_fields_set
+            if getattr(self, name) is None
+        ]
+        if nulls:
+            raise ValueError(f"Fields cannot be null: {', '.join(sorted(nulls))}")
+        return self
+
+    def changes(self) -> dict[str, Any]:
+        return self.model_dump(exclude_unset=True, by_alias=False)
+
+
+class DessertUpdateIn(DessertIn):
+    id: int
+
+
+class DessertBatchIn(CamelModel):
+    """
+    Batch of changes applied in a single transaction.
+    Creates run first, then updates, then deletes.
+    """
+
+    create: list[DessertIn] = Field(default_factory=list, max_length=5000)
+    update: list[DessertUpdateIn] = Field(default_factory=list, max_length=5000)
+    delete: list[int] = Field(default_factory=list, max_length=5000)
+
+
+class BatchItemStatus(str, Enum):
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+    NOT_FOUND = "not_found"
+
+
+class DessertBatchItemOut(CamelModel):
+    id: int
+    status: BatchItemStatus
+    data: DessertOut | None = None
+
+
+class DessertBatchOut(CamelModel):
+    created: list[DessertBatchItemOut]
+    updated: list[DessertBatchItemOut]
+    deleted: list[DessertBatchItemOut]
+
+
+class ReservationIn(CamelModel):
+    quantity: int = Field(default=1, ge=1)
+
+
+class ReservationItemIn(ReservationIn):
+    id: int
+
+
+class ReservationBatchIn(CamelModel):
+    """Items reserved together, either all of them or none."""
+
+    items: list[ReservationItemIn] = Field(min_length=1, max_length=500)
+
+
+class ReservationStatus(str, Enum):
+    RESERVED = "reserved"
+    # enough stock, but not reserved since other items of the batch failed
+    AVAILABLE = "available"
+    INSUFFICIENT_STOCK = "insufficient_stock"
+    NOT_FOUND = "not_found"
+
+
+class ReservationItemOut(CamelModel):
+    id: int
+    quantity: int
+    status: ReservationStatus
+    # after the reservation, or what is left if it was insufficient
+    left_in_stock: int | None = None
+
+
+class ReservationBatchOut(CamelModel):
+    reserved: bool
+    items: list[ReservationItemOut]
+
+
+class HistogramBucketView(CamelModel):
+    le: float | None = Field(description="Upper bound, null for the last bucket")
+    count: int
+
+
+class PoolStatsView(CamelModel):
+    """Live state and counters of a connection pool of this worker."""
+
+    engine: str
+    size: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    timeouts: int
+    connects: int
+    closes: int
+    invalidations: int
+    wait_seconds_sum: float
+    wait_seconds: list[HistogramBucketView]
+
+    @classmethod
+    def from_pool(cls, engine: str, pool: QueuePool) -> PoolStatsView:
+        stats: PoolStats = pool.stats  # type: ignore[attr-defined]
+        with stats.lock:
+            return cls(
+                engine=engine,
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=max(pool.overflow(), 0),
+                checkouts=stats.checkouts,
+                timeouts=stats.timeouts,
+                connects=stats.connects,
+                closes=stats.closes,
+                invalidations=stats.invalidations,
+                wait_seconds_sum=stats.wait.total,
+                wait_seconds=[
+                    HistogramBucketView(
+                        le=le if le != float("inf") else None, count=count
+                    )
+                    for le, count in stats.wait.cumulative()
+                ],
+            )
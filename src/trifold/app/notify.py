@@ -1,50 +1,230 @@
+from datetime import datetime
 from sqlalchemy import DDL
 from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
+from pydantic.alias_generators import to_camel, to_snake
+from trifold.app.config import NotifyConfig, NotifyLevel, NotifyPayload
 from trifold.app.models import CamelModel, Dessert, DessertOut
 
 NOTIFY_CHANNEL = "desserts_update"
 
-# Define the DDL statements
-notify_function = DDL(
+# pg_notify rejects payloads of 8000 bytes or more and fails the writing transaction
+NOTIFY_PAYLOAD_LIMIT = 8000
+
+# ids per bulk notification, keeps each one well below the payload limit
+BULK_CHUNK_IDS = 500
+
+COMPACT_PAYLOAD = """json_build_object(
+      'operation', op,
+      'table', 'dessert',
+      'sent_at', clock_timestamp(),
+      'seq', seq_no,
+      'table_version', table_version,
+      'id', (rec ->> 'id')::integer,
+      'version', (rec ->> 'version')::integer,
+      'changed', changed
+    )::text"""
+
+FULL_PAYLOAD = """json_build_object(
+      'operation', op,
+      'table', 'dessert',
+      'sent_at', clock_timestamp(),
+      'seq', seq_no,
+      'table_version', table_version,
+      'changed', changed,
+      'data', rec
+    )::text"""
+
+# transaction-local setting holding the table version of the current transaction
+TABLE_VERSION_SETTING = "trifold.table_version"
+
+ROW_TRIGGERS = ["desserts_notify_trigger"]
+STATEMENT_TRIGGERS = [
+    "desserts_notify_insert",
+    "desserts_notify_update",
+    "desserts_notify_delete",
+]
+
+
+# Called by the notify triggers and in RETURNING clauses of the API writes,
+# so they learn the version of their change without another round trip.
+# Bumped once per transaction: its changes become visible together, and the row
+# lock held until commit makes the versions grow in commit order.
+table_version_function = DDL(
     f"""
-DO $$
+CREATE OR REPLACE FUNCTION bump_dessert_table_version() RETURNS bigint AS $func$
+DECLARE
+  current text := current_setting('{TABLE_VERSION_SETTING}', true);
+  bumped bigint;
 BEGIN
-  -- Check if function exists, create only if it doesn't
-  BEGIN
-    PERFORM 'public.notify_desserts_update()'::regprocedure;
-  EXCEPTION WHEN undefined_function THEN
-    CREATE FUNCTION notify_desserts_update() RETURNS trigger AS $func$
-    DECLARE
-      payload json;
-    BEGIN
-      -- For DELETE operations, use OLD record; for INSERT/UPDATE use NEW record
-      IF TG_OP = 'DELETE' THEN
-        payload = json_build_object(
-          'operation', TG_OP,
-          'table', TG_TABLE_NAME,
-          'data', row_to_json(OLD)
-        );
-        PERFORM pg_notify('{NOTIFY_CHANNEL}', payload::text);
-        RETURN OLD;
-      ELSE
-        payload = json_build_object(
-          'operation', TG_OP,
-          'table', TG_TABLE_NAME,
-          'data', row_to_json(NEW)
-        );
-        PERFORM pg_notify('{NOTIFY_CHANNEL}', payload::text);
-        RETURN NEW;
-      END IF;
-    END;
-    $func$ LANGUAGE plpgsql;
-  END;
-END
-$$;
+  IF coalesce(current, '') <> '' THEN
+    RETURN current::bigint;
+  END IF;
+  UPDATE dessert_table_version SET version = version + 1
+  RETURNING version INTO bumped;
+  PERFORM set_config('{TABLE_VERSION_SETTING}', bumped::text, true);
+  RETURN bumped;
+END;
+$func$ LANGUAGE plpgsql;
 """
 )
 
-notify_trigger = DDL(
+
+def _notify_change_function(payload: str) -> DDL:
+    # functions are replaced on every start, so payload changes reach existing databases
+    return DDL(
+        f"""
+CREATE OR REPLACE FUNCTION notify_dessert_change(op text, new_row jsonb, old_row jsonb)
+RETURNS void AS $func$
+DECLARE
+  -- For DELETE operations, use OLD record; for INSERT/UPDATE use NEW record
+  rec jsonb := coalesce(new_row, old_row);
+  changed text[];
+  seq_no bigint;
+  table_version bigint;
+  payload text;
+BEGIN
+  IF op = 'UPDATE' THEN
+    SELECT coalesce(array_agg(n.key), '{{}}') INTO changed
+    FROM jsonb_each(new_row) n
+    WHERE n.value IS DISTINCT FROM old_row -> n.key;
+  END IF;
+
+  INSERT INTO dessert_change (operation, dessert_id, changed)
+  VALUES (op, (rec ->> 'id')::integer, changed)
+  RETURNING seq INTO seq_no;
+
+  table_version := bump_dessert_table_version();
+
+  -- sent_at is taken when the row changes, the commit follows right after
+  payload = {payload};
+  -- oversized rows are sent in compact form, the listener fetches them
+  IF octet_length(payload) >= {NOTIFY_PAYLOAD_LIMIT} THEN
+    payload = {COMPACT_PAYLOAD};
+  END IF;
+
+  PERFORM pg_notify('{NOTIFY_CHANNEL}', payload);
+END;
+$func$ LANGUAGE plpgsql;
+"""
+    )
+
+
+notify_row_function = DDL(
+    """
+CREATE OR REPLACE FUNCTION notify_desserts_update() RETURNS trigger AS $func$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    PERFORM notify_dessert_change(TG_OP, NULL, to_jsonb(OLD));
+    RETURN OLD;
+  ELSIF TG_OP = 'UPDATE' THEN
+    PERFORM notify_dessert_change(TG_OP, to_jsonb(NEW), to_jsonb(OLD));
+  ELSE
+    PERFORM notify_dessert_change(TG_OP, to_jsonb(NEW), NULL);
+  END IF;
+  RETURN NEW;
+END;
+$func$ LANGUAGE plpgsql;
+"""
+)
+
+
+def _notify_statement_function(bulk_threshold: int) -> DDL:
+    return DDL(
+        f"""
+CREATE OR REPLACE FUNCTION notify_desserts_statement() RETURNS trigger AS $func$
+DECLARE
+  ids integer[];
+  total integer;
+  chunks integer;
+  last_seq bigint;
+  table_version bigint;
+  rec record;
+BEGIN
+  -- transition tables only exist for the operations their trigger is defined for
+  IF TG_OP = 'DELETE' THEN
+    SELECT array_agg(id ORDER BY id) INTO ids FROM old_rows;
+  ELSE
+    SELECT array_agg(id ORDER BY id) INTO ids FROM new_rows;
+  END IF;
+  total := coalesce(cardinality(ids), 0);
+
+  IF total = 0 THEN
+    RETURN NULL;
+  END IF;
+
+  -- small statements, like the single row writes of the API, send row events
+  IF total <= {bulk_threshold} THEN
+    IF TG_OP = 'INSERT' THEN
+      FOR rec IN SELECT to_jsonb(n) AS new_row FROM new_rows n ORDER BY n.id LOOP
+        PERFORM notify_dessert_change(TG_OP, rec.new_row, NULL);
+      END LOOP;
+    ELSIF TG_OP = 'UPDATE' THEN
+      FOR rec IN
+        SELECT to_jsonb(n) AS new_row, to_jsonb(o) AS old_row
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        ORDER BY n.id
+      LOOP
+        PERFORM notify_dessert_change(TG_OP, rec.new_row, rec.old_row);
+      END LOOP;
+    ELSE
+      FOR rec IN SELECT to_jsonb(o) AS old_row FROM old_rows o ORDER BY o.id LOOP
+        PERFORM notify_dessert_change(TG_OP, NULL, rec.old_row);
+      END LOOP;
+    END IF;
+    RETURN NULL;
+  END IF;
+
+  -- larger ones are logged at once and send their ids in chunks,
+  -- clients refetch instead of applying rows
+  IF TG_OP = 'DELETE' THEN
+    WITH logged AS (
+      INSERT INTO dessert_change (operation, dessert_id)
+      SELECT TG_OP, id FROM old_rows
+      RETURNING seq
+    )
+    SELECT max(seq) INTO last_seq FROM logged;
+  ELSE
+    WITH logged AS (
+      INSERT INTO dessert_change (operation, dessert_id)
+      SELECT TG_OP, id FROM new_rows
+      RETURNING seq
+    )
+    SELECT max(seq) INTO last_seq FROM logged;
+  END IF;
+
+  table_version := bump_dessert_table_version();
+
+  chunks := ceil(total / {BULK_CHUNK_IDS}.0);
+  FOR i IN 0 .. chunks - 1 LOOP
+    PERFORM pg_notify('{NOTIFY_CHANNEL}', json_build_object(
+      'operation', TG_OP,
+      'table', TG_TABLE_NAME,
+      'sent_at', clock_timestamp(),
+      -- only the last chunk carries the sequence number, so a client that
+      -- disconnects in between replays the whole statement
+      'seq', CASE WHEN i = chunks - 1 THEN last_seq END,
+      'table_version', CASE WHEN i = chunks - 1 THEN table_version END,
+      'bulk', json_build_object(
+        'count', total,
+        'chunk', i,
+        'chunks', chunks,
+        'ids', ids[i * {BULK_CHUNK_IDS} + 1 : (i + 1) * {BULK_CHUNK_IDS}]
+      )
+    )::text);
+  END LOOP;
+  RETURN NULL;
+END;
+$func$ LANGUAGE plpgsql;
+"""
+    )
+
+
+def _drop_triggers(names: list[str]) -> list[DDL]:
+    return [DDL(f"DROP TRIGGER IF EXISTS {name} ON dessert") for name in names]
+
+
+notify_row_trigger = DDL(
     """
 DO $$
 BEGIN
@@ -62,6 +242,66 @@ $$;
 """
 )
 
+# a trigger with transition tables can only be defined for a single operation
+notify_statement_triggers = DDL(
+    """
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_trigger
+    WHERE tgname = 'desserts_notify_insert'
+  ) THEN
+    CREATE TRIGGER desserts_notify_insert
+    AFTER INSERT ON dessert
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_desserts_statement();
+
+    CREATE TRIGGER desserts_notify_update
+    AFTER UPDATE ON dessert
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_desserts_statement();
+
+    CREATE TRIGGER desserts_notify_delete
+    AFTER DELETE ON dessert
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_desserts_statement();
+  END IF;
+END
+$$;
+"""
+)
+
+
+def notify_ddl(notify: NotifyConfig) -> list[DDL]:
+    """
+    Returns the statements installing the notify functions and the triggers
+    of the configured level, dropping those of the other level.
+    """
+    payload = FULL_PAYLOAD if notify.payload == NotifyPayload.FULL else COMPACT_PAYLOAD
+    functions = [
+        table_version_function,
+        _notify_change_function(payload),
+        notify_row_function,
+        _notify_statement_function(notify.bulk_threshold),
+    ]
+    if notify.level == NotifyLevel.STATEMENT:
+        return [
+            *functions,
+            *_drop_triggers(ROW_TRIGGERS),
+            notify_statement_triggers,
+        ]
+    return [*functions, *_drop_triggers(STATEMENT_TRIGGERS), notify_row_trigger]
+
+
+def sse_frame(data: str, event: str | None = None, seq: int | None = None) -> bytes:
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    if seq is not None:
+        lines.append(f"id: {seq}")
+    lines.append(f"data: {data}")
+    return ("\n".join(lines) + "\n\n").encode()
+
 
 class OperationType(str, Enum):
     INSERT = "INSERT"
@@ -69,16 +309,165 @@ class OperationType(str, Enum):
     DELETE = "DELETE"
 
 
+class DessertKey(CamelModel):
+    """Identifies a deleted dessert whose last state is unknown."""
+
+    id: int
+
+
 class NotificationOut(CamelModel):
     operation: OperationType
-    data: DessertOut
+    data: DessertOut | DessertKey
+    # camelCase names of the updated fields, for updates only
+    changed: list[str] | None = None
+    # change log position, sent as the SSE event id
+    seq: int | None = Field(default=None, exclude=True)
+
+    def to_frame(self) -> bytes:
+        return sse_frame(self.to_json(), seq=self.seq)
+
+    def to_json(self) -> str:
+        """
+        Updates with known changed fields only carry those and the id,
+        so subscribers receive cell-level deltas instead of whole rows.
+        """
+        if (
+            self.operation == OperationType.UPDATE
+            and self.changed
+            and isinstance(self.data, DessertOut)
+        ):
+            fields = {"id", *(to_snake(name) for name in self.changed)}
+            return self.model_dump_json(
+                include={"operation": True, "changed": True, "data": fields}
+            )
+        return self.model_dump_json()
+
+    def merge(self, later: "NotificationOut") -> "NotificationOut | None":
+        """
+        Combines two events of the same dessert into the one a client would
+        end up with, or None if the dessert was created and deleted in between.
+        """
+        if self.operation == OperationType.INSERT:
+            if later.operation == OperationType.DELETE:
+                return None
+            return NotificationOut(
+                operation=OperationType.INSERT, data=later.data, seq=later.seq
+            )
+        if (
+            self.operation == OperationType.UPDATE
+            and later.operation == OperationType.UPDATE
+        ):
+            changed = None
+            if self.changed is not None and later.changed is not None:
+                changed = list(dict.fromkeys([*self.changed, *later.changed]))
+            return NotificationOut(
+                operation=OperationType.UPDATE,
+                data=later.data,
+                changed=changed,
+                seq=later.seq,
+            )
+        return later
+
+
+class BulkChange(BaseModel):
+    count: int
+    chunk: int
+    chunks: int
+    ids: list[int]
+
+
+class BulkChangeOut(CamelModel):
+    """
+    Sent as a named `bulk` SSE event for statements changing many rows.
+    Large statements are split into several events, one per chunk of ids.
+    """
+
+    operation: OperationType
+    count: int
+    chunk: int
+    chunks: int
+    ids: list[int]
+    min_id: int
+    max_id: int
+    seq: int | None = Field(default=None, exclude=True)
+
+    def to_frame(self) -> bytes:
+        return sse_frame(self.model_dump_json(), event="bulk", seq=self.seq)
+
+    @classmethod
+    def from_bulk(
+        cls, operation: OperationType, bulk: BulkChange, seq: int | None = None
+    ) -> "BulkChangeOut":
+        return cls(
+            operation=operation,
+            seq=seq,
+            count=bulk.count,
+            chunk=bulk.chunk,
+            chunks=bulk.chunks,
+            ids=bulk.ids,
+            min_id=min(bulk.ids),
+            max_id=max(bulk.ids),
+        )
 
 
 class Notification(BaseModel):
+    """
+    Payload sent by the notify trigger.
+    Full payloads carry the row, compact ones only its id and row version,
+    the row is then fetched by the listener.
+    Bulk payloads carry the ids of a chunk of rows changed by one statement.
+    The table version grows in commit order, unlike the change log sequence.
+    """
+
     operation: OperationType
-    data: Dessert
+    # missing in payloads of triggers created by older versions
+    sent_at: datetime | None = None
+    seq: int | None = None
+    table_version: int | None = None
+    changed: list[str] | None = None
+    data: Dessert | None = None
+    id: int | None = None
+    version: int | None = None
+    bulk: BulkChange | None = None
+
+    @model_validator(mode="after")
+    def check_row(self) -> "Notification":
+        if self.data is None and self.id is None and self.bulk is None:
+            raise ValueError("Notification carries neither a row nor an id")
+        if self.bulk is not None and not self.bulk.ids:
+            raise ValueError("Bulk notification carries no ids")
+        return self
+
+    @property
+    def dessert_id(self) -> int:
+        dessert_id = self.data.id if self.data is not None else self.id
+        assert dessert_id is not None
+        return dessert_id
+
+    @property
+    def needs_fetch(self) -> bool:
+        return (
+            self.data is None
+            and self.bulk is None
+            and self.operation != OperationType.DELETE
+        )
+
+    def to_out(self, fetched: DessertOut | None = None) -> NotificationOut | None:
+        """
+        Returns the event sent to subscribers. Compact inserts and updates need the
+        fetched row, None is returned if it was deleted since, which is notified next.
+        """
+        data: DessertOut | DessertKey
+        if self.data is not None:
+            data = DessertOut.from_model(self.data)
+        elif self.operation == OperationType.DELETE:
+            data = DessertKey(id=self.dessert_id)
+        elif fetched is not None:
+            data = fetched
+        else:
+            return None
 
-    def to_out(self) -> NotificationOut:
+        changed = [to_camel(c) for c in self.changed] if self.changed else None
         return NotificationOut(
-            operation=self.operation, data=DessertOut.from_model(self.data)
+            operation=self.operation, data=data, changed=changed, seq=self.seq
         )
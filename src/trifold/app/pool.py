@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Any
+
+from sqlalchemy import Engine, event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+# upper bounds of the checkout wait buckets, in seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class Histogram:
+    """Fixed-bucket histogram, with cumulative counts like Prometheus."""
+
+    bounds: tuple[float, ...] = WAIT_BUCKETS
+    counts: list[int] = field(default_factory=list)
+    total: float = 0.0
+
+    def __post_init__(self) -> None:
+        # one extra bucket for values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        result, running = [], 0
+        for bound, count in zip((*self.bounds, float("inf")), self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+
+@dataclass
+class PoolStats:
+    """
+    Counters of a connection pool, kept across pool re-creation.
+    Checkout waits include the time spent opening a new connection.
+    """
+
+    checkouts: int = 0
+    timeouts: int = 0
+    connects: int = 0
+    closes: int = 0
+    invalidations: int = 0
+    wait: Histogram = field(default_factory=Histogram)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record_wait(self, seconds: float, timed_out: bool = False) -> None:
+        with self.lock:
+            self.wait.observe(seconds)
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+
+    def increment(self, counter: str) -> None:
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class _InstrumentedPool(Pool):
+    """Times every checkout from the pool, including the ones that time out."""
+
+    stats: PoolStats
+
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record_wait(time.perf_counter() - start)
+        return conn
+
+    def recreate(self) -> Pool:
+        # the engine replaces its pool on dispose(), the stats carry over
+        pool = super().recreate()
+        pool.stats = self.stats  # type: ignore[attr-defined]
+        return pool
+
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument_pool(engine: Engine) -> PoolStats:
+    """
+    Attaches a PoolStats to the engine's (instrumented) pool and counts
+    physical connects, closes and invalidations through pool events.
+    """
+    stats = PoolStats()
+    engine.pool.stats = stats  # type: ignore[attr-defined]
+
+    event.listen(engine, "connect", lambda *_: stats.increment("connects"))
+    event.listen(engine, "close", lambda *_: stats.increment("closes"))
+    event.listen(engine, "close_detached", lambda *_: stats.increment("closes"))
+    event.listen(engine, "invalidate", lambda *_: stats.increment("invalidations"))
+    return stats
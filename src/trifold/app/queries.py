@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import base64
+import binascii
+from typing import Any, Sequence, TypeVar
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import (
+    ColumnElement,
+    Delete,
+    Insert,
+    Integer,
+    Row,
+    String,
+    Table,
+    Update,
+    any_,
+    column,
+    delete,
+    func,
+    insert,
+    or_,
+    tuple_,
+    update,
+    values,
+)
+from sqlmodel import col, select
+from sqlmodel.sql.expression import SelectOfScalar
+
+from trifold.app.models import (
+    Dessert,
+    DessertIn,
+    DessertOut,
+    DessertFilter,
+    DessertQuery,
+    DessertSortField,
+    DessertSubscription,
+    DessertUpdateIn,
+    SortOrder,
+)
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Text sort keys are compared by code point, whatever the database default is,
+# so pages served by the database and by the in-memory cache line up.
+TEXT_SORT_COLLATION = "C"
+
+T = TypeVar("T", Dessert, DessertOut, Row[Any])
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded or doesn't match the query."""
+
+
+class DessertCursor(BaseModel):
+    sort_by: DessertSortField
+    order: SortOrder
+    value: int | float | str
+    id: int
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self.model_dump_json().encode()).decode()
+
+    @classmethod
+    def decode(cls, raw: str, query: DessertQuery) -> DessertCursor:
+        try:
+            cursor = cls.model_validate_json(base64.urlsafe_b64decode(raw.encode()))
+        except (binascii.Error, ValidationError) as e:
+            raise InvalidCursorError("Malformed cursor") from e
+
+        if cursor.sort_by != query.sort_by or cursor.order != query.order:
+            raise InvalidCursorError("Cursor was issued for a different sort order")
+        return cursor
+
+    @classmethod
+    def after(
+        cls, model: Dessert | DessertOut | Row[Any], query: DessertQuery
+    ) -> DessertCursor:
+        assert model.id is not None, f"Dessert {model.name} has no id"
+        return cls(
+            sort_by=query.sort_by,
+            order=query.order,
+            value=getattr(model, query.sort_by.column_name),
+            id=model.id,
+        )
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def sort_column(field: DessertSortField) -> Any:
+    column = col(getattr(Dessert, field.column_name))
+    # sqlmodel's AutoString decorates String rather than subclassing it
+    if isinstance(getattr(column.type, "impl", column.type), String):
+        return column.collate(TEXT_SORT_COLLATION)
+    return column
+
+
+def filter_clauses(query: DessertFilter) -> list[ColumnElement[bool]]:
+    clauses: list[ColumnElement[bool]] = []
+    if query.name_prefix:
+        # a plain LIKE 'prefix%' pattern can be served by the text_pattern_ops index
+        clauses.append(
+            col(Dessert.name).like(escape_like(query.name_prefix) + "%", escape="\\")
+        )
+    if query.min_price is not None:
+        clauses.append(col(Dessert.price) >= query.min_price)
+    if query.max_price is not None:
+        clauses.append(col(Dessert.price) <= query.max_price)
+    if query.min_stock is not None:
+        clauses.append(col(Dessert.left_in_stock) >= query.min_stock)
+    if query.max_stock is not None:
+        clauses.append(col(Dessert.left_in_stock) <= query.max_stock)
+    return clauses
+
+
+def matches(query: DessertFilter, row: DessertOut) -> bool:
+    """In-memory counterpart of `filter_clauses`."""
+    return (
+        (not query.name_prefix or row.name.startswith(query.name_prefix))
+        and (query.min_price is None or row.price >= query.min_price)
+        and (query.max_price is None or row.price <= query.max_price)
+        and (query.min_stock is None or row.left_in_stock >= query.min_stock)
+        and (query.max_stock is None or row.left_in_stock <= query.max_stock)
+    )
+
+
+def keyset_clause(query: DessertQuery, cursor: DessertCursor) -> ColumnElement[bool]:
+    desc = query.order == SortOrder.DESC
+    if query.sort_by == DessertSortField.ID:
+        id_col = col(Dessert.id)
+        return id_col < cursor.id if desc else id_col > cursor.id
+
+    # row comparison lets Postgres use the (sort_key, id) index directly
+    key = tuple_(sort_column(query.sort_by), col(Dessert.id))
+    bound = tuple_(cursor.value, cursor.id)
+    return key < bound if desc else key > bound
+
+
+def build_select(query: DessertQuery) -> SelectOfScalar[Dessert]:
+    """
+    Builds the list query: filters, keyset condition, ordering and limit.
+    One extra row is fetched to find out whether there is a next page.
+    """
+    stmt = select(Dessert).where(*filter_clauses(query))
+
+    if query.cursor:
+        stmt = stmt.where(
+            keyset_clause(query, DessertCursor.decode(query.cursor, query))
+        )
+
+    columns = [col(Dessert.id)]
+    if query.sort_by != DessertSortField.ID:
+        columns.insert(0, sort_column(query.sort_by))
+    if query.order == SortOrder.DESC:
+        stmt = stmt.order_by(*(c.desc() for c in columns))
+    else:
+        stmt = stmt.order_by(*columns)
+
+    if query.limit is not None:
+        stmt = stmt.limit(query.limit + 1)
+    return stmt
+
+
+def paginate(rows: Sequence[T], query: DessertQuery) -> tuple[Sequence[T], str | None]:
+    """Trims the look-ahead row and returns the cursor of the next page, if any."""
+    if query.limit is None or len(rows) <= query.limit:
+        return rows, None
+    page = rows[: query.limit]
+    return page, DessertCursor.after(page[-1], query).encode()
+
+
+def dessert_table() -> Table:
+    return Dessert.__table__  # type: ignore[attr-defined]
+
+
+def written_columns(table: Table) -> list[Any]:
+    """Returned by every write, the row and the table version of its transaction."""
+    return [*table.c, func.bump_dessert_table_version().label("table_version")]
+
+
+def insert_many(items: Sequence[DessertIn]) -> Insert:
+    """Single multi-row INSERT returning the created rows in input order."""
+    table = dessert_table()
+    return (
+        insert(table)
+        .values([item.model_dump(by_alias=False) for item in items])
+        .returning(*written_columns(table))
+    )
+
+
+def update_many(items: Sequence[DessertUpdateIn]) -> Update:
+    """
+    Single UPDATE ... FROM (VALUES ...) statement, returning only the rows that exist.
+    """
+    table = dessert_table()
+    columns = [c for c in table.c if c.name != "version"]
+    rows = values(*(column(c.name, c.type) for c in columns), name="v").data(
+        [tuple(getattr(item, c.name) for c in columns) for item in items]
+    )
+    return (
+        update(table)
+        .where(table.c.id == rows.c.id)
+        .values({c.name: rows.c[c.name] for c in columns if c.name != "id"})
+        .returning(*written_columns(table))
+    )
+
+
+def build_snapshot(subscription: DessertSubscription, limit: int) -> Any:
+    """Rows matching a subscription, with one extra row to detect overflow."""
+    table = dessert_table()
+    stmt = select(*table.c).where(*filter_clauses(subscription))
+    if subscription.ids is not None:
+        stmt = stmt.where(table.c.id.in_(subscription.ids))
+    return stmt.order_by(table.c.id).limit(limit + 1)
+
+
+def row_clauses(
+    dessert_id: int, versions: Sequence[int] | None = None
+) -> list[ColumnElement[bool]]:
+    """Selects one row, only in one of the given versions if there are any."""
+    table = dessert_table()
+    clauses = [table.c.id == dessert_id]
+    if versions is not None:
+        clauses.append(table.c.version.in_(versions))
+    return clauses
+
+
+def update_one(
+    dessert_id: int, changes: dict[str, Any], versions: Sequence[int] | None = None
+) -> Update:
+    """
+    Writes only the given fields, returning the row with its version bumped
+    by the trigger. Rows that already hold the given values are left alone
+    and not returned.
+    """
+    table = dessert_table()
+    return (
+        update(table)
+        .where(
+            *row_clauses(dessert_id, versions),
+            or_(*(table.c[name].is_distinct_from(v) for name, v in changes.items())),
+        )
+        .values(changes)
+        .returning(*written_columns(table))
+    )
+
+
+def reserve_many(quantities: dict[int, int]) -> Update:
+    """
+    Single conditional UPDATE taking the quantities from the stock of every
+    dessert that has enough left, returning only those rows.
+    Concurrent reservations wait for the row lock and re-check the stock,
+    so none are lost. The join doesn't lock rows in any given order, so they are
+    locked in ascending id order first, and reservations of several desserts
+    don't deadlock. Reading the locked ids into an array makes Postgres lock
+    them all before the update starts.
+    """
+    table = dessert_table()
+    rows = values(column("id", Integer), column("quantity", Integer), name="r").data(
+        sorted(quantities.items())
+    )
+    locked = (
+        select(table.c.id)
+        .where(table.c.id.in_(list(quantities)))
+        .order_by(table.c.id)
+        .with_for_update()
+        .cte("locked")
+    )
+    locked_ids = func.array(select(locked.c.id).scalar_subquery())
+    return (
+        update(table)
+        .add_cte(locked)
+        .where(
+            table.c.id == rows.c.id,
+            table.c.id == any_(locked_ids),
+            table.c.left_in_stock >= rows.c.quantity,
+        )
+        .values(left_in_stock=table.c.left_in_stock - rows.c.quantity)
+        .returning(*written_columns(table))
+    )
+
+
+def delete_one(dessert_id: int, versions: Sequence[int] | None = None) -> Delete:
+    table = dessert_table()
+    return (
+        delete(table)
+        .where(*row_clauses(dessert_id, versions))
+        .returning(*written_columns(table))
+    )
+
+
+def delete_many(ids: Sequence[int]) -> Delete:
+    table = dessert_table()
+    return delete(table).where(table.c.id.in_(ids)).returning(*written_columns(table))
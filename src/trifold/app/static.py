@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+from functools import cached_property
+from mimetypes import guess_type
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from trifold.app.utils import etag_matches
+
+# Vite writes content-hashed bundles here, a changed file always gets a new name
+HASHED_ASSETS_DIR = "assets"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# in order of preference, the variants are written by hooks/app_build.py
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+def accepted_encodings(headers: Headers) -> set[str]:
+    """Content codings of the Accept-Encoding header, except those refused with q=0."""
+    accepted = set()
+    for item in headers.get("accept-encoding", "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        q = next((p[2:] for p in params if p.startswith("q=")), "1")
+        try:
+            if coding and float(q) > 0:
+                accepted.add(coding.lower())
+        except ValueError:
+            continue
+    return accepted
+
+
+class IndexPage:
+    """
+    index.html kept in memory with its compressed variants.
+    It is served for every deep link of the SPA, so it isn't read from disk each time.
+    """
+
+    def __init__(self, path: Path) -> None:
+        body = path.read_bytes()
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, mtime=0)}
+        brotli_path = path.with_name(path.name + ENCODINGS["br"])
+        if brotli_path.exists():
+            self.bodies["br"] = brotli_path.read_bytes()
+        # each variant is a different representation, with its own ETag
+        self.etags = {
+            encoding: f'"{digest}"'
+            if encoding == "identity"
+            else f'"{digest}-{encoding}"'
+            for encoding in self.bodies
+        }
+
+    def response(self, headers: Headers) -> Response:
+        accepted = accepted_encodings(headers)
+        encoding = next(
+            (e for e in ENCODINGS if e in accepted and e in self.bodies), "identity"
+        )
+        response_headers = {
+            "ETag": self.etags[encoding],
+            "Cache-Control": REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(headers.get("if-none-match"), self.etags[encoding]):
+            return Response(status_code=304, headers=response_headers)
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return Response(
+            self.bodies[encoding], media_type="text/html", headers=response_headers
+        )
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Serves the SPA build, preferring the brotli or gzip variant of a file when the
+    client accepts it. Content-hashed assets are cached by browsers for good,
+    everything else has to be revalidated.
+    """
+
+    def __init__(self, *, directory: Path, html: bool = False) -> None:
+        super().__init__(directory=directory, html=html)
+        self.root = Path(directory).resolve()
+
+    @cached_property
+    def index(self) -> IndexPage:
+        return IndexPage(self.root / "index.html")
+
+    def file_response(
+        self,
+        full_path: os.PathLike[str] | str,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        path = Path(full_path)
+        relative = path.relative_to(self.root)
+        if relative == Path("index.html"):
+            return self.index.response(request_headers)
+
+        headers = {
+            "Cache-Control": IMMUTABLE
+            if relative.parts[0] == HASHED_ASSETS_DIR
+            else REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+        served, served_stat = path, stat_result
+        accepted = accepted_encodings(request_headers)
+        for encoding, suffix in ENCODINGS.items():
+            if encoding not in accepted:
+                continue
+            variant = path.with_name(path.name + suffix)
+            try:
+                served, served_stat = variant, os.stat(variant)
+            except FileNotFoundError:
+                continue
+            headers["Content-Encoding"] = encoding
+            break
+
+        response = FileResponse(
+            served,
+            status_code=status_code,
+            stat_result=served_stat,
+            media_type=guess_type(path.name)[0],
+            headers=headers,
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -1,47 +1,329 @@
 from __future__ import annotations
 
+from abc import ABC, abstractmethod
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import logging
-from typing import Any, Callable, Generic, TypeVar
+import threading
+from typing import Any, Awaitable, Callable, Generic, TypeVar
 import time
 
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 
+from trifold.app.metrics import CACHE_EVENTS
+
 T = TypeVar("T")
+K = TypeVar("K")
+V = TypeVar("V")
+L = TypeVar("L", threading.Lock, asyncio.Lock)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    errors: int = 0
+    evictions: int = 0
+    expirations: int = 0
 
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
 
-class TimedCachedProperty(Generic[T]):
-    """A property decorator that caches the result for a specified duration."""
 
-    def __init__(self, ttl_seconds: int) -> None:
+@dataclass
+class _CacheEntry(Generic[L]):
+    lock: L
+    value: Any = None
+    has_value: bool = False
+    updated_at: float = 0.0
+    refreshing: bool = False
+    stats: CacheStats = field(default_factory=CacheStats)
+    task: asyncio.Task[None] | None = None
+
+
+class _TimedCache(ABC, Generic[L]):
+    """
+    Shared machinery of the timed cached properties.
+    Values are stored per instance, in the instance __dict__ (like functools.cached_property).
+    """
+
+    def __init__(
+        self, ttl_seconds: float, stale_while_revalidate: bool = False
+    ) -> None:
         self.ttl_seconds = ttl_seconds
-        self.cached_value: T | None = None
-        self.last_updated: float | None = None
-        self.func: Callable[..., T] | None = None
+        self.stale_while_revalidate = stale_while_revalidate
+        self.name = ""
+        self._entries_lock = threading.Lock()
+
+    def __set_name__(self, owner: Any, name: str) -> None:
+        self.name = name
+
+    @property
+    def _slot(self) -> str:
+        return f"__timed_cache_{self.name}"
+
+    @abstractmethod
+    def _new_lock(self) -> L:
+        """Returns the lock guarding the recomputation of one instance's value."""
+
+    def _entry(self, instance: Any) -> _CacheEntry[L]:
+        entry = instance.__dict__.get(self._slot)
+        if entry is None:
+            with self._entries_lock:
+                entry = instance.__dict__.get(self._slot)
+                if entry is None:
+                    entry = _CacheEntry(lock=self._new_lock())
+                    instance.__dict__[self._slot] = entry
+        return entry
+
+    def _is_fresh(self, entry: _CacheEntry[L]) -> bool:
+        return (
+            entry.has_value and time.monotonic() - entry.updated_at <= self.ttl_seconds
+        )
 
-    def __call__(self, func: Callable[..., T]) -> TimedCachedProperty[T]:
+    def _store(self, entry: _CacheEntry[L], value: Any) -> None:
+        entry.value = value
+        entry.has_value = True
+        entry.updated_at = time.monotonic()
+        entry.stats.refreshes += 1
+
+    def stats(self, instance: Any) -> CacheStats:
+        return self._entry(instance).stats
+
+    def invalidate(self, instance: Any) -> None:
+        """Drops the cached value, the next access recomputes it."""
+        entry = self._entry(instance)
+        entry.has_value = False
+        entry.value = None
+
+
+class TimedCachedProperty(_TimedCache[threading.Lock], Generic[T]):
+    """
+    A property decorator that caches the result for a specified duration.
+    Concurrent threads hitting an expired value wait for a single recomputation.
+    With `stale_while_revalidate`, an expired value is returned immediately
+    while a background thread recomputes it.
+    """
+
+    def __init__(
+        self, ttl_seconds: float, stale_while_revalidate: bool = False
+    ) -> None:
+        super().__init__(ttl_seconds, stale_while_revalidate)
+        self.func: Callable[[Any], T] | None = None
+
+    def __call__(self, func: Callable[[Any], T]) -> TimedCachedProperty[T]:
         self.func = func
         return self
 
+    def _new_lock(self) -> threading.Lock:
+        return threading.Lock()
+
     def __get__(self, instance: Any, owner: Any = None) -> T:
         if instance is None:
             return self  # type: ignore
 
-        current_time = time.time()
+        entry = self._entry(instance)
+        if self._is_fresh(entry):
+            entry.stats.hits += 1
+            return entry.value
 
-        # Check if we need to refresh the cache
-        if (
-            self.last_updated is None
-            or current_time - self.last_updated > self.ttl_seconds
-        ):
-            if self.func is not None:
-                self.cached_value = self.func(instance)
-                self.last_updated = current_time
+        if entry.has_value and self.stale_while_revalidate:
+            entry.stats.hits += 1
+            self._refresh_in_background(instance, entry)
+            return entry.value
 
-        return self.cached_value  # type: ignore[return-value]
+        with entry.lock:
+            # the value may have been computed while we were waiting for the lock
+            if self._is_fresh(entry):
+                entry.stats.hits += 1
+                return entry.value
+            entry.stats.misses += 1
+            return self._compute(instance, entry)
 
-    def __set_name__(self, owner: Any, name: str) -> None:
+    def _compute(self, instance: Any, entry: _CacheEntry[threading.Lock]) -> T:
+        assert self.func is not None, f"{self.name} has no function to compute"
+        try:
+            value = self.func(instance)
+        except Exception:
+            entry.stats.errors += 1
+            raise
+        self._store(entry, value)
+        return value
+
+    def _refresh_in_background(
+        self, instance: Any, entry: _CacheEntry[threading.Lock]
+    ) -> None:
+        with self._entries_lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+
+        def refresh() -> None:
+            try:
+                with entry.lock:
+                    self._compute(instance, entry)
+            except Exception as e:
+                logger.error(f"Background refresh of {self.name} failed: {e}")
+            finally:
+                entry.refreshing = False
+
+        threading.Thread(
+            target=refresh, name=f"refresh-{self.name}", daemon=True
+        ).start()
+
+
+class AsyncTimedCachedProperty(_TimedCache[asyncio.Lock], Generic[T]):
+    """
+    Async variant of `TimedCachedProperty` for coroutine producers.
+    Accessing the property returns an awaitable: `value = await obj.prop`.
+    With `stale_while_revalidate`, the refresh runs as a background task.
+    """
+
+    def __init__(
+        self, ttl_seconds: float, stale_while_revalidate: bool = False
+    ) -> None:
+        super().__init__(ttl_seconds, stale_while_revalidate)
+        self.func: Callable[[Any], Awaitable[T]] | None = None
+
+    def __call__(
+        self, func: Callable[[Any], Awaitable[T]]
+    ) -> AsyncTimedCachedProperty[T]:
+        self.func = func
+        return self
+
+    def _new_lock(self) -> asyncio.Lock:
+        return asyncio.Lock()
+
+    def __get__(self, instance: Any, owner: Any = None) -> Awaitable[T]:
+        if instance is None:
+            return self  # type: ignore
+        return self._get(instance)
+
+    async def _get(self, instance: Any) -> T:
+        entry = self._entry(instance)
+        if self._is_fresh(entry):
+            entry.stats.hits += 1
+            return entry.value
+
+        if entry.has_value and self.stale_while_revalidate:
+            entry.stats.hits += 1
+            if not entry.refreshing:
+                entry.refreshing = True
+                entry.task = asyncio.create_task(
+                    self._background_refresh(instance, entry)
+                )
+            return entry.value
+
+        async with entry.lock:
+            if self._is_fresh(entry):
+                entry.stats.hits += 1
+                return entry.value
+            entry.stats.misses += 1
+            return await self._compute(instance, entry)
+
+    async def _compute(self, instance: Any, entry: _CacheEntry[asyncio.Lock]) -> T:
+        assert self.func is not None, f"{self.name} has no function to compute"
+        try:
+            value = await self.func(instance)
+        except Exception:
+            entry.stats.errors += 1
+            raise
+        self._store(entry, value)
+        return value
+
+    async def _background_refresh(
+        self, instance: Any, entry: _CacheEntry[asyncio.Lock]
+    ) -> None:
+        try:
+            async with entry.lock:
+                await self._compute(instance, entry)
+        except Exception as e:
+            logger.error(f"Background refresh of {self.name} failed: {e}")
+        finally:
+            entry.refreshing = False
+            entry.task = None
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Bounded mapping with least-recently-used eviction and per-entry expiry.
+    Expired entries are dropped when accessed, or when they reach the LRU end.
+    Hits, misses, evictions and expirations are counted in `stats`,
+    and exported as Prometheus counters labeled with the cache `name`.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl_seconds: float) -> None:
         self.name = name
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            stat: CACHE_EVENTS.labels(name, stat)
+            for stat in ("hits", "misses", "evictions", "expirations")
+        }
+
+    def _record(self, stat: str) -> None:
+        setattr(self.stats, stat, getattr(self.stats, stat) + 1)
+        self._counters[stat].inc()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._record("misses")
+                return None
+            expires_at, value = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                self._record("expirations")
+                self._record("misses")
+                return None
+            self._data.move_to_end(key)
+            self._record("hits")
+            return value
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                _, (expires_at, _) = self._data.popitem(last=False)
+                if time.monotonic() >= expires_at:
+                    self._record("expirations")
+                else:
+                    self._record("evictions")
+
+    def pop(self, key: K) -> V | None:
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else None
+
+
+def etag_matches(if_none_match: str | None, etag: str | None) -> bool:
+    """
+    Checks an If-None-Match header value against the current ETag.
+    Uses the weak comparison required for If-None-Match by RFC 9110.
+    """
+    if not if_none_match or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    current = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == current for tag in if_none_match.split(",")
+    )
 
 
 def configure_consistent_logging() -> None:
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import Annotated, Any, Literal, Union
+
+from pydantic import Field, TypeAdapter
+
+from trifold.app.models import (
+    CamelModel,
+    DessertOut,
+    DessertPatchIn,
+    DessertSubscription,
+)
+from trifold.app.notify import BulkChangeOut, NotificationOut, OperationType
+from trifold.app.queries import matches
+
+# larger slices should be read page by page through the list endpoint
+SNAPSHOT_LIMIT = 10_000
+
+# rows are sent as arrays in this order, announced with every snapshot
+COLUMNS = ["id", "name", "price", "description", "leftInStock", "version"]
+
+UPSERT = "U"
+REMOVE = "D"
+
+
+class SubscribeMessage(CamelModel):
+    type: Literal["subscribe"]
+    filter: DessertSubscription = Field(default_factory=DessertSubscription)
+
+
+class EditMessage(CamelModel):
+    type: Literal["edit"]
+    # echoed back in the ack or error, to match them with the edit
+    ref: str | int | None = None
+    id: int
+    # written only if the row is still in this version
+    version: int | None = None
+    changes: DessertPatchIn
+
+
+ClientMessage = TypeAdapter(
+    Annotated[Union[SubscribeMessage, EditMessage], Field(discriminator="type")]
+)
+
+
+def encode_row(row: DessertOut) -> list[Any]:
+    return [
+        row.id,
+        row.name,
+        row.price,
+        row.description,
+        row.left_in_stock,
+        row.version,
+    ]
+
+
+class DeltaSession:
+    """
+    Server-side state of one WebSocket subscription.
+    The ids sent to the client are tracked, so rows that stop matching the
+    filter after an update can be removed from the client's slice.
+    """
+
+    def __init__(self) -> None:
+        self.subscription: DessertSubscription | None = None
+        self._ids: set[int] | None = None
+        self._sent: set[int] = set()
+
+    def subscribe(self, subscription: DessertSubscription) -> None:
+        self.subscription = subscription
+        self._ids = set(subscription.ids) if subscription.ids is not None else None
+        self._sent = set()
+
+    def snapshot(self, rows: list[DessertOut]) -> dict[str, Any]:
+        self._sent = {row.id for row in rows}
+        return {
+            "type": "snapshot",
+            "columns": COLUMNS,
+            "rows": [encode_row(row) for row in rows],
+        }
+
+    def matches(self, row: DessertOut) -> bool:
+        assert self.subscription is not None
+        if self._ids is not None and row.id not in self._ids:
+            return False
+        return matches(self.subscription, row)
+
+    def needs_snapshot(self, events: list[NotificationOut | BulkChangeOut]) -> bool:
+        """Bulk inserts and updates carry no rows, the slice is reloaded instead."""
+        return any(
+            isinstance(event, BulkChangeOut)
+            and event.operation != OperationType.DELETE
+            and (self._ids is None or not self._ids.isdisjoint(event.ids))
+            for event in events
+        )
+
+    def deltas(self, events: list[NotificationOut | BulkChangeOut]) -> list[list[Any]]:
+        if self.subscription is None:
+            return []
+
+        deltas: list[list[Any]] = []
+        for event in events:
+            if isinstance(event, BulkChangeOut):
+                # only bulk deletes get here, see needs_snapshot
+                deltas.extend(self._remove(dessert_id) for dessert_id in event.ids)
+            elif event.operation != OperationType.DELETE and isinstance(
+                event.data, DessertOut
+            ):
+                if self.matches(event.data):
+                    self._sent.add(event.data.id)
+                    deltas.append([UPSERT, *encode_row(event.data)])
+                else:
+                    deltas.append(self._remove(event.data.id))
+            else:
+                deltas.append(self._remove(event.data.id))
+        return [delta for delta in deltas if delta]
+
+    def _remove(self, dessert_id: int) -> list[Any]:
+        if dessert_id not in self._sent:
+            return []
+        self._sent.discard(dessert_id)
+        return [REMOVE, dessert_id]
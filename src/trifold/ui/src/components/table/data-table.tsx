@@ -17,7 +17,7 @@ import {
   TableHeader,
   TableRow,
 } from "@/components/ui/table";
-import { useDessertsSuspense, type DessertOut } from "@/lib/api";
+import { desserts, useDessertsSuspense, type DessertOut } from "@/lib/api";
 import { columns } from "@/components/table/columns";
 import { Skeleton } from "@/components/ui/skeleton";
 import FadeIn from "@/components/FadeIn";
@@ -30,7 +30,17 @@ enum OperationType {
 
 interface Notification {
   operation: OperationType;
-  data: DessertOut;
+  // updates may only carry the id and the changed fields
+  data: Partial<DessertOut> & Pick<DessertOut, "id">;
+  changed: string[] | null;
+}
+
+interface BulkChange {
+  operation: OperationType;
+  count: number;
+  chunk: number;
+  chunks: number;
+  ids: number[];
 }
 
 function DessertTableContent({ initialData }: { initialData: DessertOut[] }) {
@@ -48,10 +58,16 @@ function DessertTableContent({ initialData }: { initialData: DessertOut[] }) {
       const { operation, data } = JSON.parse(event.data) as Notification;
       switch (operation) {
         case OperationType.INSERT:
-          setData((prev) => [...prev, data]);
+          // may already be part of a list refetched after a resync
+          setData((prev) => [
+            ...prev.filter((d) => d.id !== data.id),
+            data as DessertOut,
+          ]);
           break;
         case OperationType.UPDATE:
-          setData((prev) => prev.map((d) => (d.id === data.id ? data : d)));
+          setData((prev) =>
+            prev.map((d) => (d.id === data.id ? { ...d, ...data } : d)),
+          );
           break;
         case OperationType.DELETE:
           setData((prev) => prev.filter((d) => d.id !== data.id));
@@ -59,6 +75,25 @@ function DessertTableContent({ initialData }: { initialData: DessertOut[] }) {
       }
     };
 
+    // statements changing many rows only send their ids
+    eventSource.addEventListener("bulk", (event) => {
+      const { operation, chunk, chunks, ids } = JSON.parse(
+        (event as MessageEvent).data,
+      ) as BulkChange;
+      if (operation === OperationType.DELETE) {
+        const deleted = new Set(ids);
+        setData((prev) => prev.filter((d) => !deleted.has(d.id)));
+      } else if (chunk === chunks - 1) {
+        // refetch once the last chunk of the statement has arrived
+        desserts().then(({ data }) => setData(data));
+      }
+    });
+
+    // sent when this client fell too far behind and events were dropped
+    eventSource.addEventListener("resync", () => {
+      desserts().then(({ data }) => setData(data));
+    });
+
     // Cleanup function to close the EventSource
     return () => {
       eventSource.close();